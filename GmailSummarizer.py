@@ -2,45 +2,48 @@
 # Date - 2/8/2024
 
 import os
+import argparse
 import base64
+import gzip
+import html
+import hashlib
+import importlib
 import json
 import re
+import signal
+import sys
 import logging
-from datetime import datetime, timedelta
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient import errors
-from googleapiclient.http import BatchHttpRequest
-from google.cloud import texttospeech
-from openai import OpenAI
-from pathlib import Path
-from bs4 import BeautifulSoup
+import math
+import random
+import queue
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime, parseaddr
 import quopri
+import sqlite3
+from contextlib import closing, contextmanager, nullcontext
 
-BASE_DIR = 'C:\\Users\\example\\Desktop\\GmailSummarizer\\' # ADD YOUR BASE DIRECTORY HERE
+# The Google, OpenAI and HTML parsing libraries are slow to import, so they are imported
+# inside the functions that use them. Importing this module has no side effects.
 
-# Set up logging
-log_file = os.path.join(BASE_DIR, 'app.log')
-logging.basicConfig(
-    filename=log_file,
-    filemode='a', 
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
+BASE_DIR = 'C:\\Users\\example\\Desktop\\GmailSummarizer\\' # ADD YOUR BASE DIRECTORY HERE
+LOG_FILE_PATH = os.path.join(BASE_DIR, 'app.log')
 
 # Define the scope
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
-# Initialize the OpenAI client
-client = OpenAI(api_key='API KEY HERE') # ADD YOUR OPEN AI API KEY HERE
+# OpenAI API key
+OPENAI_API_KEY = 'API KEY HERE' # ADD YOUR OPEN AI API KEY HERE
 
 # Base paths
 TOKEN_PATH = os.path.join(BASE_DIR, 'token.json')
 SERVICE_ACCOUNT_PATH = os.path.join(BASE_DIR, 'key\\UPDATE THIS FILE NAME.json') # MAKE SURE TO UPDATE TO YOUR FILENAME
-EMAILS_JSON_PATH = os.path.join(BASE_DIR, 'emails.json')
-EMAILS_SUBDIR = os.path.join(BASE_DIR, 'emails')
+EMAILS_DB_PATH = os.path.join(BASE_DIR, 'emails.db')
 
 # Output paths
 OUTPUT_DIR = os.path.join(BASE_DIR, 'output')
@@ -50,16 +53,193 @@ SSML_OUTPUT_FILE_PATH = os.path.join(OUTPUT_DIR, 'formatted_summary.ssml')
 
 # Audio output
 TTS_AUDIO_OUTPUT_FILE_PATH = os.path.join(OUTPUT_DIR, 'email_summary.mp3')
+TTS_VOICE_NAME = "en-US-Journey-F"
+TTS_LANGUAGE_CODE = "en-US"
+TTS_MAX_CHUNK_BYTES = 4500 # Text-to-Speech accepts at most 5000 bytes per request
+TTS_CONCURRENCY = 4 # Audio segments synthesized at the same time
+TTS_SEGMENT_SENTENCES = 4 # Average sentences per audio segment, shorter segments keep more cached audio when the brief changes
+
+# HTML extraction settings
+HTML_EXTRACTOR = 'fast' # 'fast' (regex tag stripper), 'lxml' (needs lxml installed) or 'bs4' (BeautifulSoup html.parser)
+MAX_HTML_CHARS = 500000 # HTML past this length is not processed, very long newsletters are cut off
+
+# Summary cache
+SUMMARY_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'summaries')
+DIGEST_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'digests')
+TTS_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'audio')
+SUMMARY_CACHE_MAX_AGE_DAYS = 30 # Cached summaries, digests and audio older than this are deleted
+SUMMARY_CACHE_MAX_ENTRIES = 5000 # Least recently used entries in each cache are deleted past this count
+
+# Summarization settings
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_CONCURRENCY = 4 # Number of emails summarized at the same time, set to 1 to summarize one by one
+REQUESTS_PER_MINUTE = 500 # Match these to the rate limits of your OpenAI account
+TOKENS_PER_MINUTE = 200000
+MAX_RETRIES = 5 # Retries for rate limited or temporarily failing API requests
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRYABLE_403_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded') # Gmail also rate limits users with a 403
+DIGEST_MERGE_TOKEN_BUDGET = 6000 # Sender digests past this are merged in rounds before writing the brief
+SUMMARY_INPUT_TOKEN_BUDGET = 4000 # Longer emails are split into parts that are summarized first, then combined
+MAX_SUMMARY_CHUNKS = 8 # Parts past this are dropped, so one email costs at most this many extra requests
+SUMMARY_BATCHING = True # Summarize several short emails in one request, set to False to send one request per email
+SUMMARY_BATCH_EMAIL_MAX_TOKENS = 600 # Emails up to this many tokens are batched, longer ones are summarized on their own
+SUMMARY_BATCH_TOKEN_BUDGET = 4000 # Email tokens per batch request, more emails fit in a batch when they are shorter
+SUMMARY_BATCH_MAX_EMAILS = 10 # Emails per batch request, each one can use up to 300 output tokens
+GROUP_THREADS = True # Summarize the emails of a thread that arrive in the same update together, set to False to summarize each reply
+NEAR_DUPLICATE_THRESHOLD = 0.8 # Emails at least this similar (0 to 1) are summarized once, set to 1 to only skip exact copies
+NEAR_DUPLICATE_MIN_WORDS = 20 # Shorter emails are never treated as duplicates
+NEAR_DUPLICATE_MAX_WORDS = 5000 # Only the start of longer emails is compared, which keeps very long newsletters fast
+
+# Gmail fetch settings
+GMAIL_PAGE_SIZE = 500 # Largest page size messages().list allows
+GMAIL_BATCH_SIZE = 50 # Gmail allows at most 100 requests per batch, larger batches get rate limited
+GMAIL_BATCHES_IN_FLIGHT = 4 # Number of batch requests sent at the same time
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=5) # Gmail credentials are refreshed this long before they expire
+STORE_WRITE_BATCH_SIZE = 200 # Emails written to the local store per transaction
+PIPELINE_QUEUE_SIZE = 100 # Emails waiting to be summarized before fetching pauses
+
+# Triage settings. The label, sender and size rules are sent with the Gmail search, so skipped emails
+# are never listed. The List-Unsubscribe rule, other labels and emails found through the history
+# are checked on the metadata of each email before its body is downloaded.
+TRIAGE_SKIP_LABELS = ['CATEGORY_PROMOTIONS'] # Emails with any of these Gmail label IDs are not downloaded or summarized
+TRIAGE_SENDER_ALLOWLIST = [] # Addresses or @domains that are always downloaded, for example 'boss@example.com' or '@example.com'
+TRIAGE_SENDER_DENYLIST = [] # Addresses or @domains that are never downloaded
+TRIAGE_SKIP_BULK_MAIL = False # Skip emails with a List-Unsubscribe header, such as newsletters and notifications
+TRIAGE_MAX_SIZE_BYTES = 0 # Skip emails larger than this, 0 for no limit
+TRIAGE_HEADERS = ['From', 'Subject', 'Date', 'List-Unsubscribe']
+
+# Decoding and stripping settings
+PROCESS_WORKERS = 0 # Processes used to decode and strip emails, 0 uses every CPU core, 1 keeps it in the fetch threads
+PROCESS_POOL_MIN_EMAILS = 500 # Smaller updates are decoded in the fetch threads, starting the processes costs more
+PROCESS_CHUNK_SIZE = 10 # Emails sent to a worker process at a time
+
+# Logging and metrics settings
+LOG_LEVEL = logging.INFO # Set to logging.DEBUG to log every step
+MIME_PART_LOG_LEVEL = logging.DEBUG # Level of the line logged for every MIME part, only written when LOG_LEVEL includes it
+METRICS_ENABLED = True # Time the Gmail, decoding, OpenAI and Text-to-Speech steps and count the bytes and tokens used
+METRICS_FILE_PATH = os.path.join(OUTPUT_DIR, 'run_metrics.json')
+
 
+# Set up logging
+def configure_logging(level=None):
+    logging.basicConfig(
+        filename=LOG_FILE_PATH,
+        filemode='a', 
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=level or LOG_LEVEL
+    )
 
 # Ensure output directories exist
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
-    logging.info(f"Created output directory: {OUTPUT_DIR}")
+def ensure_directories():
+    for directory in (OUTPUT_DIR, SUMMARY_CACHE_DIR, DIGEST_CACHE_DIR, TTS_CACHE_DIR):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+            logging.info(f"Created directory: {directory}")
+
+# Import an optional dependency on first use, None when it is not installed.
+def import_optional(module_name):
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        return None
 
-if not os.path.exists(EMAILS_SUBDIR):
-    os.makedirs(EMAILS_SUBDIR)
-    logging.info(f"Created emails subdirectory: {EMAILS_SUBDIR}")
+# Times one call of a stage, see Metrics.timer.
+class StageTimer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+# Wall time of each stage and totals such as bytes and tokens, shared by all threads.
+# Worker processes keep their own copy, so decoding in a process pool is only timed as
+# a whole by the 'decode_pool' stage.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.now(timezone.utc)
+            self.stages = {}
+            self.counters = {}
+
+    # Context manager timing one call of the stage. Does nothing when metrics are disabled.
+    def timer(self, stage):
+        if not METRICS_ENABLED:
+            return nullcontext()
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+            stats['calls'] += 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def add(self, counter, amount=1):
+        if not METRICS_ENABLED or not amount:
+            return
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def report(self):
+        with self.lock:
+            return {
+                'started_at': self.started_at.isoformat(),
+                'duration_seconds': round((datetime.now(timezone.utc) - self.started_at).total_seconds(), 3),
+                'stages': {
+                    stage: {
+                        'calls': stats['calls'],
+                        'total_seconds': round(stats['total_seconds'], 6),
+                        'mean_seconds': round(stats['total_seconds'] / stats['calls'], 6),
+                        'max_seconds': round(stats['max_seconds'], 6),
+                    }
+                    for stage, stats in sorted(self.stages.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    # The metrics in the Prometheus text format, for the node_exporter textfile collector.
+    def to_prometheus(self):
+        report = self.report()
+        lines = [
+            "# HELP gmail_summarizer_stage_seconds_total Wall time spent in each stage.",
+            "# TYPE gmail_summarizer_stage_seconds_total counter",
+        ]
+        lines += [f'gmail_summarizer_stage_seconds_total{{stage="{stage}"}} {stats["total_seconds"]}' for stage, stats in report['stages'].items()]
+        lines += [
+            "# HELP gmail_summarizer_stage_calls_total Calls of each stage.",
+            "# TYPE gmail_summarizer_stage_calls_total counter",
+        ]
+        lines += [f'gmail_summarizer_stage_calls_total{{stage="{stage}"}} {stats["calls"]}' for stage, stats in report['stages'].items()]
+        for counter, value in report['counters'].items():
+            lines += [f"# TYPE gmail_summarizer_{counter}_total counter", f"gmail_summarizer_{counter}_total {value}"]
+        return "\n".join(lines) + "\n"
+
+    # Write the JSON run report, with extra fields such as the command stats.
+    def write_report(self, path, **extra):
+        with open(path, 'w', encoding='utf-8') as report_file:
+            json.dump({**extra, **self.report()}, report_file, indent=4)
+
+    # Replace the file in one step so a collector never reads it half written.
+    def write_prometheus(self, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as prometheus_file:
+            prometheus_file.write(self.to_prometheus())
+        os.replace(path + '.tmp', path)
+
+
+metrics = Metrics()
 
 #Clear the terminal screen based on the operating system.
 def clear_screen():
@@ -82,19 +262,25 @@ def display_menu(menu_title, options):
             print("Invalid input. Please try again.")
 
 def main_menu():
-    options = ["Get Text Summary", "Get Audio Summary", "Update Emails", "Settings", "Quit"]
+    options = ["Get Text Summary", "Get Audio Summary", "Update Emails", "Update and Summarize", "Settings", "Quit"]
     return display_menu("Email Summarizer", options)
 
 def settings_menu():
-    options = ["Change Timeframe", "Fix GMAIL link issues", "Go Back"]
+    options = ["Change Timeframe", "Fix GMAIL link issues", "Full Email Resync", "Go Back"]
     return display_menu("Settings", options)
 
 def timeframe_menu():
     options = ["Past 24 Hours", "Past 48 Hours", "Past 72 Hours"]
     return display_menu("Select Timeframe", options)
 
-# Authenticate google token
-def gmail_authenticate():
+# Authenticate google token. Without interactive the browser sign in is never started,
+# so scheduled runs fail instead of waiting for a login.
+def gmail_authenticate(interactive=True):
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.exceptions import RefreshError
+    from google.auth.transport.requests import Request
+
     creds = None
     if os.path.exists(TOKEN_PATH):
         creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
@@ -103,7 +289,17 @@ def gmail_authenticate():
         logging.info("No valid credentials, starting authentication flow...")
         if creds and creds.expired and creds.refresh_token:
             logging.info("Refreshing credentials...")
-            creds.refresh(Request())
+            try:
+                creds.refresh(Request())
+            except RefreshError as e:
+                if interactive:
+                    raise
+                # A revoked or expired refresh token, signing in again is the only fix
+                logging.error(f"Error refreshing credentials: {e}")
+                raise AuthenticationError(f"Gmail credentials could not be refreshed, run the interactive menu to sign in again: {e}")
+        elif not interactive:
+            logging.error("No valid Gmail credentials, run the interactive menu once to sign in")
+            return None
         else:
             logging.info("Starting OAuth flow using credentials.json")
             try:
@@ -121,60 +317,603 @@ def gmail_authenticate():
     return creds
 
 
-# Function to fetch emails within a specified timeframe
-def get_emails_within_timeframe(service, hours):
+# Split an iterable into lists of at most size items.
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Creates the Gmail, OpenAI and Text-to-Speech clients once and shares them between menu actions.
+# Gmail connections are kept in a pool, so batches reuse open keep-alive connections
+# instead of repeating the TLS handshake on every update.
+class Services:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.creds = None
+        self.gmail_service = None
+        self.openai_client = None
+        self.tts_client = None
+        self.http_pool = queue.LifoQueue()
+
+    # Run the Gmail sign in and rebuild the Gmail client with the new credentials.
+    def authenticate(self, interactive=True):
+        with self.lock:
+            self.creds = gmail_authenticate(interactive)
+            self.gmail_service = None
+            self.http_pool = queue.LifoQueue()
+        return self.creds
+
+    # Refresh the Gmail credentials shortly before they expire, so it never happens inside a request.
+    def ensure_fresh_credentials(self):
+        creds = self.creds
+        if not creds or not creds.refresh_token:
+            return
+        if creds.expiry and creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None) > CREDENTIAL_REFRESH_MARGIN:
+            return
+
+        from google.auth.transport.requests import Request
+
+        with self.lock:
+            logging.info("Refreshing Gmail credentials before they expire...")
+            try:
+                creds.refresh(Request())
+            except Exception as e:
+                logging.error(f"Error refreshing credentials: {e}")
+                return
+            with open(TOKEN_PATH, 'w') as token:
+                token.write(creds.to_json())
+
+    @property
+    def gmail(self):
+        if not self.creds:
+            return None
+        from googleapiclient.discovery import build
+
+        self.ensure_fresh_credentials()
+        with self.lock:
+            if self.gmail_service is None:
+                # The bundled discovery document is used, so building the client needs no request
+                self.gmail_service = build('gmail', 'v1', credentials=self.creds, static_discovery=True)
+            return self.gmail_service
+
+    @property
+    def openai(self):
+        from openai import OpenAI
+
+        with self.lock:
+            if self.openai_client is None:
+                # request_completion() handles retries, including dropped connections, and rate limits itself
+                self.openai_client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+            return self.openai_client
+
+    @property
+    def tts(self):
+        from google.cloud import texttospeech
+
+        with self.lock:
+            if self.tts_client is None:
+                self.tts_client = texttospeech.TextToSpeechClient.from_service_account_file(SERVICE_ACCOUNT_PATH)
+            return self.tts_client
+
+    # Borrow an authorized Gmail connection. httplib2 is not thread safe, so every
+    # fetch thread needs its own connection while a batch is running. build_http() gives
+    # each connection the same timeout as the connection build() makes.
+    @contextmanager
+    def gmail_http(self):
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.http import build_http
+
+        http_pool = self.http_pool
+        try:
+            http = http_pool.get_nowait()
+        except queue.Empty:
+            http = AuthorizedHttp(self.creds, http=build_http())
+        try:
+            yield http
+        finally:
+            http_pool.put(http)
+
+
+services = Services()
+
+# Execute a Gmail API request, backing off on rate limit and server errors.
+def execute_with_retries(request, http=None):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return request.execute(http=http)
+        except Exception as e:
+            delay = get_retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                raise
+            logging.warning(f"Gmail request failed ({e}), retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+
+# Page through every message ID that matches the query. The thread ID of each message
+# is recorded in thread_ids when it is given.
+def list_message_ids(service, query, thread_ids=None):
+    page_token = None
+    while True:
+        with metrics.timer('gmail_list'):
+            result = execute_with_retries(
+                service.users().messages().list(userId='me', q=query, maxResults=GMAIL_PAGE_SIZE, pageToken=page_token)
+            )
+        for msg in result.get('messages', []):
+            if thread_ids is not None:
+                thread_ids[msg['id']] = msg.get('threadId')
+            yield msg['id']
+
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return
+
+# Get one batch of messages in the given format. Sub-requests that fail with a retryable
+# error are sent again in a smaller batch after backing off. When process is given each
+# response is replaced by process(response) as soon as it arrives. The IDs of messages
+# that still could not be fetched are added to failed when it is given, apart from
+# messages that no longer exist.
+def execute_batch_gets(service, message_ids, process=None, failed=None, **get_args):
+    messages = []
+    pending = list(message_ids)
+
+    for attempt in range(MAX_RETRIES + 1):
+        retry_ids = []
+        retry_delays = [0]
+
+        def handle_batch_response(request_id, response, exception):
+            if exception is None:
+                messages.append(process(response) if process else response)
+                return
+
+            delay = get_retry_delay(exception, attempt)
+            if delay is not None and attempt < MAX_RETRIES:
+                retry_ids.append(request_id)
+                retry_delays.append(delay)
+            else:
+                logging.error(f"Error fetching message {request_id}: {exception}")
+                if failed is not None and get_error_status(exception) != 404:
+                    failed.append(request_id)
+
+        batch = service.new_batch_http_request(callback=handle_batch_response)
+        for message_id in pending:
+            batch.add(service.users().messages().get(userId='me', id=message_id, **get_args), request_id=message_id)
+
+        try:
+            with services.gmail_http() as http, metrics.timer('gmail_batch_get'):
+                batch.execute(http=http)
+        except Exception as e:
+            delay = get_retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                logging.error(f"Error fetching batch of {len(pending)} messages: {e}")
+                if failed is not None:
+                    failed.extend(pending)
+                break
+            retry_ids = pending
+            retry_delays.append(delay)
+
+        if not retry_ids:
+            break
+
+        delay = max(retry_delays)
+        logging.warning(f"Retrying {len(retry_ids)} messages in {delay:.1f} seconds")
+        time.sleep(delay)
+        pending = retry_ids
+
+    return messages
+
+# Fetch and process one batch of messages. With a process pool the messages are
+# decoded and stripped in the worker processes. Otherwise each message is decoded as
+# it arrives, so its raw payload is released straight away instead of with the batch.
+def fetch_message_batch(service, message_ids, process_pool=None, failed=None):
+    if process_pool:
+        messages = execute_batch_gets(service, message_ids, failed=failed, format='full')
+        metrics.add('gmail_bytes', sum(message.get('sizeEstimate', 0) for message in messages))
+        with metrics.timer('decode_pool'):
+            emails = list(process_pool.map(process_and_strip_email, messages, chunksize=PROCESS_CHUNK_SIZE))
+    else:
+        def decode(message):
+            metrics.add('gmail_bytes', message.get('sizeEstimate', 0))
+            return process_email(message)
+
+        emails = execute_batch_gets(service, message_ids, process=decode, failed=failed, format='full')
+
+    metrics.add('gmail_messages', len(emails))
+    return emails
+
+# Start a process pool for decoding and stripping when there are enough emails to pay for it.
+# Returns an empty context when the emails should be processed in the fetch threads.
+def start_process_pool(email_count):
+    if PROCESS_WORKERS == 1 or email_count < PROCESS_POOL_MIN_EMAILS:
+        return nullcontext()
+    from concurrent.futures import ProcessPoolExecutor
+
+    logging.info(f"Decoding {email_count} emails with a process pool")
+    return ProcessPoolExecutor(max_workers=PROCESS_WORKERS or None, initializer=configure_logging)
+
+# Run fetch_batch(service, batch_ids, *args) for each batch of the message IDs. Several
+# batches run at once and each result is yielded as soon as it completes.
+def iter_batches(fetch_batch, service, message_ids, *args):
+    with ThreadPoolExecutor(max_workers=GMAIL_BATCHES_IN_FLIGHT) as executor:
+        in_flight = set()
+        for batch_ids in chunked(message_ids, GMAIL_BATCH_SIZE):
+            if len(in_flight) >= GMAIL_BATCHES_IN_FLIGHT:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            in_flight.add(executor.submit(fetch_batch, service, batch_ids, *args))
+
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+# Stream batches of processed emails for the given message IDs. The IDs of emails that
+# could not be downloaded are added to failed when it is given.
+def iter_email_batches(service, message_ids, process_pool=None, failed=None):
+    return iter_batches(fetch_message_batch, service, message_ids, process_pool, failed)
+
+# Get the labels, size and triage headers of one batch of messages, without the body.
+def fetch_metadata_batch(service, message_ids):
+    messages = execute_batch_gets(service, message_ids, format='metadata', metadataHeaders=TRIAGE_HEADERS)
+    metrics.add('gmail_metadata_bytes', sum(len(json.dumps(message)) for message in messages))
+    return messages
+
+# Gmail search terms matching the labels that can be skipped in the search itself.
+TRIAGE_LABEL_QUERIES = {
+    'CATEGORY_PROMOTIONS': 'category:promotions',
+    'CATEGORY_SOCIAL': 'category:social',
+    'CATEGORY_UPDATES': 'category:updates',
+    'CATEGORY_FORUMS': 'category:forums',
+    'IMPORTANT': 'is:important',
+    'STARRED': 'is:starred',
+    'UNREAD': 'is:unread',
+}
+
+# Whether the metadata of each message has to be checked. Messages listed with
+# triage_query() were already filtered on their labels, sender and size, and messages
+# from the history on their labels by list_history_changes().
+def triage_enabled(listed=False, labelled=False):
+    if listed:
+        return TRIAGE_SKIP_BULK_MAIL or any(label not in TRIAGE_LABEL_QUERIES for label in TRIAGE_SKIP_LABELS)
+    if labelled and history_label_triage():
+        return bool(TRIAGE_SENDER_DENYLIST or TRIAGE_SKIP_BULK_MAIL or TRIAGE_MAX_SIZE_BYTES)
+    return bool(TRIAGE_SKIP_LABELS or TRIAGE_SENDER_DENYLIST or TRIAGE_SKIP_BULK_MAIL or TRIAGE_MAX_SIZE_BYTES)
+
+# Whether the label rule can be applied on the labels in the history. Allowed senders
+# are kept whatever their labels, which takes the From header of each message.
+def history_label_triage():
+    return not TRIAGE_SENDER_ALLOWLIST
+
+# Gmail search terms for the label, sender and size rules, empty when there are none.
+# Allowed senders are kept whatever the other rules say.
+def triage_query():
+    terms = [f"-{TRIAGE_LABEL_QUERIES[label]}" for label in TRIAGE_SKIP_LABELS if label in TRIAGE_LABEL_QUERIES]
+    terms += [f"-from:{sender.lstrip('@')}" for sender in TRIAGE_SENDER_DENYLIST]
+    if TRIAGE_MAX_SIZE_BYTES:
+        terms.append(f"smaller:{TRIAGE_MAX_SIZE_BYTES + 1}")
+    if not terms:
+        return ''
+
+    query = ' '.join(terms)
+    if TRIAGE_SENDER_ALLOWLIST:
+        query = ' OR '.join([f"({query})"] + [f"from:{sender.lstrip('@')}" for sender in TRIAGE_SENDER_ALLOWLIST])
+    return f"({query})"
+
+def sender_matches(address, senders):
+    domain = address.rpartition('@')[2]
+    return any(sender.lower() in (address, '@' + domain) for sender in senders)
+
+# Decide from the metadata of a message whether it is downloaded and summarized.
+# Returns why it is skipped, or None to keep it.
+def triage_reason(metadata):
+    headers = {header['name'].lower(): header['value'] for header in metadata.get('payload', {}).get('headers', [])}
+    address = parseaddr(headers.get('from', ''))[1].lower()
+
+    if sender_matches(address, TRIAGE_SENDER_ALLOWLIST):
+        return None
+    if sender_matches(address, TRIAGE_SENDER_DENYLIST):
+        return 'sender'
+    if set(metadata.get('labelIds', [])) & set(TRIAGE_SKIP_LABELS):
+        return 'label'
+    if TRIAGE_SKIP_BULK_MAIL and 'list-unsubscribe' in headers:
+        return 'bulk'
+    if TRIAGE_MAX_SIZE_BYTES and metadata.get('sizeEstimate', 0) > TRIAGE_MAX_SIZE_BYTES:
+        return 'size'
+    return None
+
+# Keep the message IDs that pass the triage rules, checking the metadata of each message
+# first so skipped emails are never downloaded in full. Messages whose metadata could
+# not be fetched are kept. listed is True for IDs from list_timeframe_message_ids(),
+# whose metadata is only checked for the rules the search could not apply, and labelled
+# for IDs from list_history_changes().
+def triage_message_ids(service, message_ids, listed=False, labelled=False):
+    message_ids = list(message_ids)
+    if not triage_enabled(listed, labelled) or not message_ids:
+        return message_ids
+
+    skipped = {}
+    for batch in iter_batches(fetch_metadata_batch, service, message_ids):
+        for metadata in batch:
+            reason = triage_reason(metadata)
+            if reason:
+                skipped[metadata['id']] = reason
+                metrics.add(f'triage_skipped_{reason}')
+
+    logging.info(f"Triage kept {len(message_ids) - len(skipped)} of {len(message_ids)} emails")
+    return [message_id for message_id in message_ids if message_id not in skipped]
+
+def iter_emails(service, message_ids):
+    for emails in iter_email_batches(service, message_ids):
+        yield from emails
+
+# Page through the IDs of every email within a specified timeframe that passes the
+# triage rules of triage_query().
+def list_timeframe_message_ids(service, hours, thread_ids=None):
     today = datetime.now()
     timeframe = today - timedelta(hours=hours)
-    query = f"after:{int(timeframe.timestamp())}"
+    query = f"after:{int(timeframe.timestamp())} {triage_query()}".strip()
 
     logging.info(f"Fetching emails within {hours} hours timeframe...")
+    return list_message_ids(service, query, thread_ids)
+
+# Stream processed emails within a specified timeframe, following every page of results.
+def iter_emails_within_timeframe(service, hours):
+    return iter_emails(service, triage_message_ids(service, list_timeframe_message_ids(service, hours), listed=True))
+
+# Function to fetch emails within a specified timeframe
+def get_emails_within_timeframe(service, hours):
     email_data = []
 
     try:
-        result = service.users().messages().list(userId='me', q=query).execute()
-        messages = result.get('messages', [])
+        for email in iter_emails_within_timeframe(service, hours):
+            email_data.append(email)
 
-        if not messages:
+        if not email_data:
             logging.info("No emails found.")
-            return email_data
+        else:
+            logging.info(f"Successfully fetched {len(email_data)} emails.")
 
-        logging.info(f"Fetched {len(messages)} email message IDs.")
-        batch = service.new_batch_http_request()
+    except Exception as error:
+        logging.error(f"Error fetching emails: {error}")
 
-        def handle_batch_response(request_id, response, exception):
-            if exception:
-                logging.error(f"Error fetching message {request_id}: {exception}")
-            else:
-                email_data.append(process_email(response))
+    return email_data
 
-        # Add each message request to the batch
-        for msg in messages:
-            batch.add(
-                service.users().messages().get(userId='me', id=msg['id'], format='full'),
-                callback=handle_batch_response
-            )
 
-        batch.execute()
-        logging.info(f"Successfully fetched {len(email_data)} emails.")
+def get_current_history_id(service):
+    return execute_with_retries(service.users().getProfile(userId='me'))['historyId']
 
-    except Exception as error:
-        logging.error(f"Error fetching emails: {error}")
+# Labels of the messages that messages.list leaves out, so a full sync never stores them.
+HIDDEN_LABELS = {'SPAM', 'TRASH'}
 
-    return email_data
+# Collect the messages added and deleted since the given history ID. Added messages
+# are returned as a dict of message ID to thread ID. Messages moved to the spam or the
+# trash count as deleted, and messages taken back out of them count as added. Added
+# messages with a label the triage skips are left out.
+def list_history_changes(service, start_history_id):
+    added, deleted, labels = {}, set(), {}
+    history_id = start_history_id
+    page_token = None
+
+    while True:
+        with metrics.timer('gmail_history'):
+            result = execute_with_retries(
+                service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                    pageToken=page_token
+                )
+            )
+        for record in result.get('history', []):
+            label_changes = record.get('labelsAdded', []) + record.get('labelsRemoved', [])
+            for item in record.get('messagesAdded', []) + label_changes:
+                labels[item['message']['id']] = item['message'].get('labelIds', [])
+
+            changed = record.get('messagesAdded', []) + [
+                item for item in label_changes if HIDDEN_LABELS & set(item.get('labelIds', []))
+            ]
+            for item in changed:
+                message = item['message']
+                if HIDDEN_LABELS & set(message.get('labelIds', [])):
+                    deleted.add(message['id'])
+                    added.pop(message['id'], None)
+                else:
+                    added[message['id']] = message.get('threadId')
+                    deleted.discard(message['id'])
+            for item in record.get('messagesDeleted', []):
+                deleted.add(item['message']['id'])
+                added.pop(item['message']['id'], None)
+
+        history_id = result.get('historyId', history_id)
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+
+    # Apply the label rule of the triage on the latest labels of each message, so these
+    # emails need no metadata request
+    if history_label_triage() and TRIAGE_SKIP_LABELS:
+        skipped = [message_id for message_id in added if set(labels[message_id]) & set(TRIAGE_SKIP_LABELS)]
+        for message_id in skipped:
+            del added[message_id]
+        metrics.add('triage_skipped_label', len(skipped))
+    return added, deleted, history_id
+
+# Store a batch of fetched emails. When a pipeline is given the emails are stripped
+# straight away and handed over for summarizing while the next batch downloads.
+def store_fetched_emails(conn, emails, pipeline=None):
+    if pipeline:
+        for email in emails:
+            if email.stripped_text is None:
+                email.stripped_text = strip_email_body(email.body)
+            email.token_count = count_email_tokens(email.stripped_text)
+
+    store_emails(conn, emails)
+
+    if pipeline:
+        for email in emails:
+            pipeline.submit(email.id, email.stripped_text, email.sender, email.date, email.token_count, email.thread_id)
+
+# Download and strip every email in the timeframe, replacing the local store. Stored
+# emails are only removed once the download has finished, so a failed sync keeps them.
+def full_sync(conn, service, hours, pipeline=None):
+    # Read the history ID first so nothing that arrives during the download is missed next time
+    history_id = get_current_history_id(service)
+
+    thread_ids = {}
+    message_ids = triage_message_ids(service, list_timeframe_message_ids(service, hours, thread_ids), listed=True)
+    if pipeline:
+        pipeline.expect_threads(thread_ids.get(message_id) for message_id in message_ids)
+
+    count = 0
+    failed = []
+    with start_process_pool(len(message_ids)) as process_pool:
+        for emails in iter_email_batches(service, message_ids, process_pool, failed):
+            store_fetched_emails(conn, emails, pipeline)
+            count += len(emails)
+    strip_emails(conn)
+
+    # Emails that failed to download keep their stored copy until they are fetched again
+    listed_ids = set(message_ids)
+    stale_ids = [row['id'] for row in conn.execute("SELECT id FROM messages") if row['id'] not in listed_ids]
+    with conn:
+        removed = conn.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in stale_ids]).rowcount
+    requeue_orphaned_duplicates(conn)
+
+    save_fetch_pending(conn, {message_id: thread_ids.get(message_id) for message_id in failed})
+    set_sync_state(conn, history_id=history_id, hours=hours, synced_at=time.time())
+    logging.info(f"Full sync complete, {count} emails stored and {removed} removed.")
+    return count, removed
+
+# Remember the emails that could not be downloaded, as a dict of message ID to thread ID.
+# The history ID moves past them, so the next incremental sync fetches them from here.
+def save_fetch_pending(conn, fetch_pending):
+    if fetch_pending:
+        logging.warning(f"{len(fetch_pending)} emails could not be downloaded, they are tried again on the next update")
+    set_sync_state(conn, fetch_pending=json.dumps(fetch_pending))
+
+# Apply the changes since the last sync to the local store. Emails that are already
+# stored are never downloaded or stripped again, and emails that failed to download last
+# time are tried again.
+def incremental_sync(conn, service, hours, pipeline=None):
+    start_history_id = get_sync_state(conn, 'history_id')
+    added, deleted, history_id = list_history_changes(service, start_history_id)
+    logging.info(f"History since {start_history_id}: {len(added)} added, {len(deleted)} deleted")
+
+    fetch_pending = json.loads(get_sync_state(conn, 'fetch_pending') or '{}')
+    for message_id, thread_id in fetch_pending.items():
+        if message_id not in deleted:
+            added.setdefault(message_id, thread_id)
+
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours=hours)).timestamp()
+    with conn:
+        removed = conn.execute("DELETE FROM messages WHERE date_ts < ?", (cutoff,)).rowcount
+        removed += conn.executemany("DELETE FROM messages WHERE id = ?", [(message_id,) for message_id in deleted]).rowcount
+    requeue_orphaned_duplicates(conn)
+
+    stored_ids = {row['id'] for row in conn.execute("SELECT id FROM messages")}
+    new_ids = [message_id for message_id in added if message_id not in stored_ids]
+    new_ids = triage_message_ids(service, new_ids, labelled=True)
+    if pipeline:
+        pipeline.expect_threads(added[message_id] for message_id in new_ids)
+
+    new_count = 0
+    failed = []
+    with start_process_pool(len(new_ids)) as process_pool:
+        for emails in iter_email_batches(service, new_ids, process_pool, failed):
+            # Unreadable dates are kept, the same as a full sync would
+            emails = [email for email in emails if (parse_email_date(email.date) or cutoff) >= cutoff]
+            store_fetched_emails(conn, emails, pipeline)
+            new_count += len(emails)
+    strip_emails(conn)
+
+    save_fetch_pending(conn, {message_id: added[message_id] for message_id in failed})
+    set_sync_state(conn, history_id=history_id, hours=hours, synced_at=time.time())
+    logging.info(f"Incremental sync complete, {new_count} new and {removed} removed emails.")
+    return new_count, removed
+
+# Update the local email store, using the Gmail history when a previous sync covers the timeframe.
+def update_store(conn, service, hours, full=False, pipeline=None):
+    synced_hours = float(get_sync_state(conn, 'hours') or 0)
+    synced_at = float(get_sync_state(conn, 'synced_at') or time.time())
+    # The store holds everything from the start of the last synced timeframe onwards, so a
+    # --since date that stays the same between runs keeps using the history. The minute of
+    # slack covers the time between working out the timeframe and starting the sync.
+    covered = synced_hours + (time.time() - synced_at) / 3600 + 1 / 60
+
+    if not full and get_sync_state(conn, 'history_id') and covered >= hours:
+        try:
+            return incremental_sync(conn, service, hours, pipeline)
+        except Exception as e:
+            # Gmail returns 404 once the saved history ID is too old to use
+            if get_error_status(e) != 404:
+                logging.error(f"Error during incremental sync: {e}")
+                raise
+            logging.warning("Saved history ID has expired, running a full sync")
+
+    return full_sync(conn, service, hours, pipeline)
+
+# Update the local email store. With summarize=True every new email is summarized while
+# the rest are still downloading, and the summary file is rewritten at the end.
+# Returns the counts of added and removed emails, and of summaries when summarizing.
+def sync_emails(service, hours, full=False, summarize=False, concurrency=SUMMARY_CONCURRENCY):
+    with closing(open_store()) as conn:
+        if not summarize:
+            added, removed = update_store(conn, service, hours, full)
+            return {'added': added, 'removed': removed}
+
+        summary_cache_stats.update(hits=0, misses=0)
+        with SummaryPipeline(conn, concurrency) as pipeline:
+            added, removed = update_store(conn, service, hours, full, pipeline)
+        # Pick up emails left unsummarized by earlier runs
+        summarized, failed, duplicates = summarize_pending_emails(conn, concurrency, retry_failed=False)
+        return {
+            'added': added,
+            'removed': removed,
+            'summarized': pipeline.summarized + summarized,
+            'summary_failures': pipeline.failed + failed,
+            'duplicates': pipeline.duplicates + duplicates,
+            **finish_summaries(conn)
+        }
+
+
+# A fetched email. Slots keep the records of a large update small, and only the decoded
+# fields are kept, not the raw Gmail payload.
+class EmailRecord:
+    __slots__ = ('id', 'thread_id', 'sender', 'subject', 'date', 'body', 'stripped_text', 'token_count')
 
+    def __init__(self, id, thread_id=None, sender='', subject='', date='', body='', stripped_text=None, token_count=None):
+        self.id = id
+        self.thread_id = thread_id
+        self.sender = sender
+        self.subject = subject
+        self.date = date
+        self.body = body
+        self.stripped_text = stripped_text  # None until stripped
+        self.token_count = token_count  # None until counted
 
 # Helper function to process individual email message
 def process_email(message):
-    payload = message['payload']
-    headers = {header['name']: header['value'] for header in payload.get('headers', [])}
+    with metrics.timer('decode'):
+        payload = message['payload']
+        headers = {header['name']: header['value'] for header in payload.get('headers', [])}
+
+        return EmailRecord(
+            id=message['id'],
+            thread_id=message.get('threadId'),
+            sender=headers.get('From', ''),
+            subject=headers.get('Subject', ''),
+            date=headers.get('Date', ''),
+            body=extract_email_body(payload)
+        )
 
-    return {
-        'id': message['id'],
-        'from': headers.get('From', ''),
-        'subject': headers.get('Subject', ''),
-        'date': headers.get('Date', ''),
-        'body': extract_email_body(payload)
-    }
+# Process and strip a raw Gmail message. Runs in the worker processes, using the same
+# functions as the serial path so the results are identical.
+def process_and_strip_email(message):
+    email = process_email(message)
+    email.stripped_text = strip_email_body(email.body)
+    return email
 
 # Decodes the email body based on the encoding.
 def decode_body(data, encoding='base64'):
@@ -191,8 +930,54 @@ def decode_body(data, encoding='base64'):
         logging.error(f"Error decoding body: {e}")
     return ""
 
+# Elements whose content is never part of the readable text: styles, scripts, the head and comments.
+HTML_HIDDEN_CONTENT = re.compile(
+    r'<(script|style|head|title|noscript|template)\b.*?</\1\s*>|<!--.*?-->',
+    re.IGNORECASE | re.DOTALL
+)
+HTML_BLOCK_TAG = re.compile(r'<(?:br|/?p|/?div|/?tr|/?li|/?h[1-6]|/?table|/?td|/?th)\b[^>]*>', re.IGNORECASE)
+HTML_TAG = re.compile(r'<[^>]*>')
+LXML_HIDDEN_ELEMENTS = '//script|//style|//head|//noscript|//template'
+
+# Strip tags with regular expressions instead of building a document tree.
+def extract_text_fast(html_text):
+    html_text = HTML_HIDDEN_CONTENT.sub('', html_text)
+    html_text = HTML_BLOCK_TAG.sub('\n', html_text)
+    return html.unescape(HTML_TAG.sub('', html_text))
+
+def extract_text_lxml(html_text):
+    import lxml.html
+
+    if not html_text.strip():
+        return ''
+    document = lxml.html.fromstring(html_text)
+    for element in document.xpath(LXML_HIDDEN_ELEMENTS):
+        element.drop_tree()
+    return document.text_content()
+
+def extract_text_bs4(html_text):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html_text, 'html.parser')
+    return soup.get_text()
+
+HTML_EXTRACTORS = {
+    'fast': extract_text_fast,
+    'lxml': extract_text_lxml,
+    'bs4': extract_text_bs4,
+}
+
+# Convert an HTML body to plain text with the configured extractor.
+def html_to_text(html_text, extractor=None):
+    extractor = extractor or HTML_EXTRACTOR
+    if extractor == 'lxml' and import_optional('lxml.html') is None:
+        logging.warning("lxml is not installed, using the fast HTML extractor")
+        extractor = 'fast'
+    with metrics.timer('html_extract'):
+        return HTML_EXTRACTORS[extractor](html_text[:MAX_HTML_CHARS])
+
 # Recursively extract the email body, handling multiple MIME parts.
-def extract_email_body(payload):
+def extract_email_body(payload, extractor=None):
     def get_body_from_parts(parts):
         text_body, html_body = None, None
 
@@ -206,7 +991,7 @@ def extract_email_body(payload):
                 body_data = part.get('body', {}).get('data', '')
                 encoding = part.get('body', {}).get('encoding', 'base64')
 
-                logging.info(f"Processing MIME type: {mime_type}")
+                logging.log(MIME_PART_LOG_LEVEL, "Processing MIME type: %s", mime_type)
 
                 if mime_type == 'text/plain':
                     text_body = text_body or decode_body(body_data, encoding)
@@ -222,20 +1007,18 @@ def extract_email_body(payload):
         mime_type = payload.get('mimeType', '')
         encoding = payload.get('body', {}).get('encoding', 'base64')
 
-        logging.info(f"Single-part email with MIME type: {mime_type}")
-        
+        logging.log(MIME_PART_LOG_LEVEL, "Single-part email with MIME type: %s", mime_type)
+
         if mime_type == 'text/plain':
             return decode_body(body_data, encoding).strip()
         elif mime_type == 'text/html':
-            soup = BeautifulSoup(decode_body(body_data, encoding), 'html.parser')
-            return soup.get_text().strip()
+            return html_to_text(decode_body(body_data, encoding), extractor).strip()
 
     parts = payload.get('parts', [])
     text_body, html_body = get_body_from_parts(parts) if parts else (None, None)
 
     if html_body:
-        soup = BeautifulSoup(html_body, 'html.parser')
-        return soup.get_text().strip()
+        return html_to_text(html_body, extractor).strip()
 
     return text_body.strip() if text_body else ""
 
@@ -253,57 +1036,304 @@ def save_to_json(filepath, data, message):
 def strip_email_body(text):
     if not text:
         return ''
-    text = re.sub(r'\s+', ' ', text.replace('\n', ' ').replace('\r', ' '))
-    return text.strip()
-
-
-# Function to process and strip all emails
-def strip_emails():
-    emails = load_emails(EMAILS_JSON_PATH)
-    logging.info(f"Loaded {len(emails)} emails from {EMAILS_JSON_PATH}")
-
-    for email in emails:
-        stripped_email = {
-            'from': email.get('from'),
-            'date': email.get('date'),
-            'stripped_text': strip_email_body(email.get('body', ''))
-        }
+    with metrics.timer('strip'):
+        text = re.sub(r'\s+', ' ', text.replace('\n', ' ').replace('\r', ' '))
+        return text.strip()
+
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    sender TEXT,
+    subject TEXT,
+    date TEXT,
+    date_ts REAL,
+    body TEXT,
+    stripped_text TEXT,
+    token_count INTEGER,
+    summary_status TEXT NOT NULL DEFAULT 'pending',
+    summary TEXT,
+    duplicate_of TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date_ts);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Open the local email store, creating the tables on first use.
+def open_store():
+    conn = sqlite3.connect(EMAILS_DB_PATH)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(STORE_SCHEMA)
+
+    # Stores created before these columns were added
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(messages)")}
+    for column, column_type in (('token_count', 'INTEGER'), ('thread_id', 'TEXT'), ('duplicate_of', 'TEXT')):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE messages ADD COLUMN {column} {column_type}")
+    return conn
+
+def get_sync_state(conn, key):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row['value'] if row else None
+
+def set_sync_state(conn, **values):
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+            [(key, str(value)) for key, value in values.items()]
+        )
 
-        date_str = email.get('date', '').replace(':', '-').replace(' ', '_')
-        file_name = f"{date_str}.json"
-        file_path = os.path.join(EMAILS_SUBDIR, file_name)
+# Convert an email Date header to a UTC timestamp, None when it cannot be read.
+def parse_email_date(date_header):
+    try:
+        sent = parsedate_to_datetime(date_header)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if sent.tzinfo is None:
+        sent = sent.replace(tzinfo=timezone.utc)
+    return sent.timestamp()
+
+# Save fetched emails to the store in one transaction. Emails that were not stripped
+# yet are stripped later by strip_emails().
+def store_emails(conn, emails):
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO messages "
+            "(id, thread_id, sender, subject, date, date_ts, body, stripped_text, token_count, summary_status, summary) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', NULL)",
+            [
+                (
+                    email.id,
+                    email.thread_id,
+                    email.sender,
+                    email.subject,
+                    email.date,
+                    parse_email_date(email.date),
+                    email.body,
+                    email.stripped_text,
+                    email.token_count if email.token_count is not None else count_email_tokens(email.stripped_text)
+                )
+                for email in emails
+            ]
+        )
+    logging.info(f"Saved {len(emails)} emails to {EMAILS_DB_PATH}")
 
-        save_to_json(file_path, stripped_email, f"Stripped email data saved to {file_path}")
+# Tokens of the email text that will be sent for summarizing, None until it is stripped.
+def count_email_tokens(stripped_text):
+    if stripped_text is None:
+        return None
+    return count_tokens(prepare_email_text(stripped_text))
+
+# Predict the input tokens and requests needed to summarize the emails without a summary.
+# Emails found in the summary cache will cost less than this.
+def estimate_pending_summaries(conn):
+    prompt_tokens = count_tokens(SUMMARY_SYSTEM_PROMPT + SUMMARY_PROMPT_TEMPLATE)
+    chunk_prompt_tokens = count_tokens(SUMMARY_SYSTEM_PROMPT + SUMMARY_CHUNK_PROMPT_TEMPLATE)
+    batch_prompt_tokens = count_tokens(SUMMARY_SYSTEM_PROMPT + SUMMARY_BATCH_PROMPT_TEMPLATE)
+    estimate = {'emails': 0, 'input_tokens': 0, 'requests': 0}
+    batcher = SummaryBatcher()
+
+    rows = conn.execute(
+        "SELECT token_count FROM messages WHERE summary_status IN ('pending', 'failed') AND stripped_text != '' "
+        "ORDER BY date_ts, id"
+    )
+    for row in rows:
+        token_count = row['token_count'] or 0
+        estimate['emails'] += 1
+        if SUMMARY_BATCHING and token_count <= SUMMARY_BATCH_EMAIL_MAX_TOKENS:
+            if batcher.add(None, token_count + BATCH_EMAIL_OVERHEAD_TOKENS):
+                estimate['requests'] += 1
+                estimate['input_tokens'] += batch_prompt_tokens
+            estimate['input_tokens'] += token_count + BATCH_EMAIL_OVERHEAD_TOKENS
+        elif token_count <= SUMMARY_INPUT_TOKEN_BUDGET:
+            estimate['requests'] += 1
+            estimate['input_tokens'] += prompt_tokens + token_count
+        else:
+            # Every part is summarized, then the part summaries are combined
+            chunks = count_summary_chunks(token_count)
+            estimate['requests'] += chunks + 1
+            estimate['input_tokens'] += (
+                chunks * chunk_prompt_tokens
+                + min(token_count, chunks * SUMMARY_INPUT_TOKEN_BUDGET)
+                + prompt_tokens + chunks * 300
+            )
+    return estimate
 
-# Function to save emails to JSON file
-def save_emails_to_json(emails):
+# Function to process and strip all emails that have not been stripped yet
+def strip_emails(conn):
+    count = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, body FROM messages WHERE stripped_text IS NULL LIMIT ?", (STORE_WRITE_BATCH_SIZE,)
+        ).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for row in rows:
+            stripped_text = strip_email_body(row['body'])
+            updates.append((stripped_text, count_email_tokens(stripped_text), row['id']))
+
+        with conn:
+            conn.executemany("UPDATE messages SET stripped_text = ?, token_count = ? WHERE id = ?", updates)
+        count += len(rows)
+
+    logging.info(f"Stripped {count} emails")
+    return count
+
+# Keeps the requests and tokens sent to the API within a per-minute budget shared by all threads.
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.lock = threading.Lock()
+        self.history = deque()
+        self.paused_until = 0.0
+
+    # Block until a request using the given number of tokens fits in the budget.
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.history and now - self.history[0][0] >= 60:
+                    self.history.popleft()
+
+                wait = self.paused_until - now
+                if wait <= 0:
+                    used_tokens = sum(used for _, used in self.history)
+                    if not self.history or (
+                        len(self.history) < self.requests_per_minute
+                        and used_tokens + tokens <= self.tokens_per_minute
+                    ):
+                        self.history.append((now, tokens))
+                        return
+                    wait = 60 - (now - self.history[0][0])
+
+            time.sleep(max(wait, 0.05))
+
+    # Stop every thread from sending requests for the given number of seconds.
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+# Rough token count, about four characters per token for English text.
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+token_encoding = None
+
+# Load the gpt-4o tokenizer, False when tiktoken is not installed or cannot download it.
+def load_token_encoding():
+    tiktoken = import_optional('tiktoken')
+    if not tiktoken:
+        return False
     try:
-        with open(EMAILS_JSON_PATH, 'w', encoding='utf-8') as json_file:
-            json.dump(emails, json_file, indent=4, ensure_ascii=False)
-        logging.info(f"Emails saved to {EMAILS_JSON_PATH}")
+        return tiktoken.get_encoding('o200k_base')
     except Exception as e:
-        logging.error(f"Error saving emails to JSON: {e}")
-
-# Function to load emails from file
-def load_emails(file_path):
+        # The encoding is downloaded on first use, which fails when offline
+        logging.warning(f"Could not load the tiktoken encoding, estimating tokens instead: {e}")
+        return False
+
+# Count tokens with tiktoken when it is installed, otherwise estimate them.
+def count_tokens(text):
+    global token_encoding
+    if token_encoding is None:
+        token_encoding = load_token_encoding()
+    if not token_encoding:
+        return estimate_tokens(text)
+    return len(token_encoding.encode(text, disallowed_special=()))
+
+# HTTP status of a failed OpenAI or Gmail request, None when it has none.
+def get_error_status(error):
+    status = getattr(error, 'status_code', None)
+    if status is None and getattr(error, 'resp', None) is not None:
+        # googleapiclient errors keep the status and headers on error.resp
+        status = getattr(error.resp, 'status', None)
+    return status
+
+# The reasons given in the body of a googleapiclient error, empty for other errors.
+def get_error_reasons(error):
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            emails = json.load(f)
-        return emails
-    except Exception as e:
-        logging.error(f"Error loading emails from {file_path}: {e}")
-        return []
+        details = json.loads(getattr(error, 'content', None) or '{}')['error']
+        return {item.get('reason') for item in details.get('errors', []) + details.get('details', [])}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+# Whether the request failed before any response arrived, such as a dropped connection
+# or a timeout. The OpenAI client is only checked once it has been imported.
+def is_connection_error(error):
+    openai = sys.modules.get('openai')
+    if openai is not None and isinstance(error, openai.APIConnectionError):
+        return True
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+# Return how long to wait before retrying a failed request, or None if it should not be retried.
+def get_retry_delay(error, attempt):
+    status = get_error_status(error)
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if getattr(error, 'status_code', None) is None and getattr(error, 'resp', None) is not None:
+        headers = error.resp  # googleapiclient errors keep the headers on error.resp
+
+    retryable = (
+        status in RETRYABLE_STATUS_CODES
+        or (status == 403 and get_error_reasons(error) & set(RETRYABLE_403_REASONS))
+        or is_connection_error(error)
+    )
+    if not retryable:
+        return None
 
-# Summarize emails
-def generate_summary(email_text, email_from, email_date):
     try:
-        logging.debug("Generating summary for email")
-        
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",  # Use gpt 4o mini
-            messages=[
-                {"role": "system", "content": "You are an intelligent email assistant designed to summarize emails clearly and concisely."},
-                {"role": "user", "content": f"""
+        return float((headers or {}).get('retry-after'))
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 60) + random.uniform(0, 1)
+
+# Send a chat completion request, waiting for the rate limiter and backing off on 429 responses.
+# response_format asks for structured output, for example {"type": "json_object"}.
+def request_completion(messages, max_tokens, temperature, model="gpt-4o-mini", response_format=None):
+    tokens = sum(estimate_tokens(message['content']) for message in messages) + max_tokens
+    options = {'response_format': response_format} if response_format else {}
+
+    for attempt in range(MAX_RETRIES + 1):
+        with metrics.timer('llm_wait'):
+            rate_limiter.acquire(tokens)
+        try:
+            with metrics.timer('llm_request'):
+                response = services.openai.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    **options
+                )
+        except Exception as e:
+            delay = get_retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                metrics.add('llm_failures')
+                raise
+            logging.warning(f"Completion request failed ({e}), retrying in {delay:.1f} seconds")
+            metrics.add('llm_retries')
+            rate_limiter.pause(delay)
+            continue
+
+        usage = getattr(response, 'usage', None)
+        metrics.add('llm_requests')
+        metrics.add('llm_bytes_out', sum(len(message['content'].encode('utf-8')) for message in messages))
+        metrics.add('llm_prompt_tokens', getattr(usage, 'prompt_tokens', 0) or 0)
+        metrics.add('llm_completion_tokens', getattr(usage, 'completion_tokens', 0) or 0)
+        return response
+
+SUMMARY_SYSTEM_PROMPT = "You are an intelligent email assistant designed to summarize emails clearly and concisely."
+SUMMARY_PROMPT_TEMPLATE = """
                 The following is an email. Summarize it in a structured format, adhering precisely to the template outlined below. Ensure clarity, brevity, and relevance in each section, and focus on extracting key actionable information. If you are including any quotes, quote directly.
                 
                 1. *Title*: Craft a short, specific title that reflects the main subject of the email.
@@ -316,10 +1346,133 @@ def generate_summary(email_text, email_from, email_date):
                 **From**: {email_from}
                 **Date**: {email_date}
                 **Content**: {email_text}
-                """}
+                """
+
+SUMMARY_CHUNK_PROMPT_TEMPLATE = """
+                The following is part {part} of {parts} of a long email from {email_from}. Summarize this part in a few sentences, keeping every action, key point, deadline and direct quote it contains.
+
+                **Content**: {email_text}
+                """
+
+SUMMARY_BATCH_PROMPT_TEMPLATE = """
+                The following is a JSON list of {count} separate emails, each with an id. Summarize every email on its own, adhering precisely to the template outlined below. Ensure clarity, brevity, and relevance in each section, and focus on extracting key actionable information. If you are including any quotes, quote directly.
+
+                1. *Title*: Craft a short, specific title that reflects the main subject of the email.
+                2. *Date and Sender*: The date the email was sent and by whom. This line should be formatted exactly like this Sender Email - Day/Month/Year
+                3. *Email Summary*: Write a brief and concise summary of the main points discussed in the email, focusing on essential information. This should only be a few sentences long.
+                4. *Key Takeaways*: Bullet points that highlight specific actions, key points, or deadlines from the email. Roughly two sentences if needed.
+
+                Reply with only a JSON object of the form {{"summaries": [{{"id": "<email id>", "summary": "<summary text>"}}]}}, with one entry for every email.
+
+                **Emails**: {emails}
+                """
+BATCH_EMAIL_OVERHEAD_TOKENS = 30 # Tokens of the id, sender and date added to each email in a batch
+
+# Quoted reply chains start with one of these markers. Everything after the first one is history.
+# The text is already on one line, so the markers cannot be anchored to line starts. They are
+# matched case-sensitively, and a candidate cannot run over the start of another one.
+QUOTED_REPLY_MARKER = re.compile(
+    r'\s(?:On ((?:(?! On ).){5,200}?) wrote:'
+    r'|-{2,} ?Original Message ?-{2,}'
+    r'|From: ((?:(?! From: ).){1,200}?) Sent: ((?:(?! Sent: ).){1,100}?) (?:To|Subject): )'
+)
+# An attribution line or reply header names a date, a time or an email address.
+ATTRIBUTION_DETAIL = re.compile(r'\d{1,2}:\d{2}|\b(?:19|20)\d{2}\b|\d{1,2}/\d{1,2}/\d{2,4}|[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+# Footers start with one of these phrases, only searched for near the end of the email.
+FOOTER_MARKER = re.compile(
+    r'\s(?:To unsubscribe from this|Click here to unsubscribe|Unsubscribe from this (?:list|mailing list|newsletter)'
+    r'|If you no longer wish to receive these emails|You are receiving this (?:email|message) because'
+    r'|You received this (?:email|message) because|Sent from my (?:iPhone|iPad|Android))'
+)
+FOOTER_SEARCH_FRACTION = 0.25
+
+# Position of the first quoted reply chain in the text, None when there is none.
+def find_quoted_reply(email_text):
+    match = QUOTED_REPLY_MARKER.search(email_text)
+    while match:
+        details = ' '.join(group for group in match.groups() if group)
+        # Original Message separators need no details
+        if not details or ATTRIBUTION_DETAIL.search(details):
+            return match.start()
+        match = QUOTED_REPLY_MARKER.search(email_text, match.start() + 1)
+    return None
+
+# Remove quoted reply chains and footers from stripped email text.
+def prepare_email_text(email_text):
+    start = find_quoted_reply(email_text)
+    if start is not None:
+        email_text = email_text[:start]
+
+    match = FOOTER_MARKER.search(email_text, int(len(email_text) * (1 - FOOTER_SEARCH_FRACTION)))
+    if match:
+        email_text = email_text[:match.start()]
+    return email_text.strip()
+
+def count_summary_chunks(token_count):
+    return min(max(math.ceil(token_count / SUMMARY_INPUT_TOKEN_BUDGET), 1), MAX_SUMMARY_CHUNKS)
+
+# Split text into parts of about SUMMARY_INPUT_TOKEN_BUDGET tokens, breaking on spaces.
+def split_into_chunks(email_text, token_count):
+    if token_count <= SUMMARY_INPUT_TOKEN_BUDGET:
+        return [email_text]
+
+    chunk_count = count_summary_chunks(token_count)
+
+    chunk_chars = int(len(email_text) * SUMMARY_INPUT_TOKEN_BUDGET / token_count)
+    chunks = []
+    start = 0
+    while start < len(email_text) and len(chunks) < chunk_count:
+        end = start + chunk_chars
+        if end < len(email_text):
+            space = email_text.rfind(' ', start, end)
+            if space > start:
+                end = space
+        chunks.append(email_text[start:end].strip())
+        start = end
+
+    if start < len(email_text):
+        logging.warning(f"Email is longer than {MAX_SUMMARY_CHUNKS} parts, the rest was not summarized")
+    return chunks
+
+# Summarize each part of a long email. The combined part summaries replace the email content.
+def summarize_chunks(chunks, email_from):
+    part_summaries = []
+    for part, chunk in enumerate(chunks, start=1):
+        completion = request_completion(
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": SUMMARY_CHUNK_PROMPT_TEMPLATE.format(
+                    part=part, parts=len(chunks), email_from=email_from, email_text=chunk
+                )}
+            ],
+            max_tokens=300,
+            temperature=0.4,
+            model=SUMMARY_MODEL
+        )
+        part_summaries.append(f"Part {part}: {completion.choices[0].message.content}")
+    return "\n".join(part_summaries)
+
+# Summarize one email. email_text has already been through prepare_email_text().
+def generate_summary(email_text, email_from, email_date):
+    try:
+        logging.debug("Generating summary for email")
+
+        token_count = count_tokens(email_text)
+        if token_count > SUMMARY_INPUT_TOKEN_BUDGET:
+            chunks = split_into_chunks(email_text, token_count)
+            logging.info(f"Email has {token_count} tokens, summarizing it in {len(chunks)} parts")
+            email_text = summarize_chunks(chunks, email_from)
+        
+        completion = request_completion(
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": SUMMARY_PROMPT_TEMPLATE.format(
+                    email_from=email_from, email_date=email_date, email_text=email_text
+                )}
             ],
             max_tokens=300,  # Adjusted token limit for a more detailed summary
-            temperature=0.4  # Low temperature for factual, clear summarization
+            temperature=0.4,  # Low temperature for factual, clear summarization
+            model=SUMMARY_MODEL
         )
         
         summary = completion.choices[0].message.content
@@ -329,68 +1482,592 @@ def generate_summary(email_text, email_from, email_date):
     except Exception as e:
         logging.exception("Error generating summary")
         return None
-    
-def process_emails():
-    email_files = [f for f in os.listdir(EMAILS_SUBDIR) if f.endswith('.json')]
-    logging.info(f"Found {len(email_files)} email files to process")
 
-    with open(SUMMARY_FILE_PATH, 'a', encoding='utf-8') as summary_file:
-        for email_file in email_files:
-            try:
-                with open(os.path.join(EMAILS_SUBDIR, email_file), 'r', encoding='utf-8') as f:
-                    email_data = json.load(f)
+# Summarize several short emails in one request with a JSON reply, returning the
+# summaries in the same order. Emails missing from the reply get None. The email texts
+# have already been through prepare_email_text().
+def generate_batch_summaries(emails):
+    batch = [
+        {'id': str(number), 'from': email_from, 'date': email_date, 'content': email_text}
+        for number, (email_text, email_from, email_date) in enumerate(emails, start=1)
+    ]
+    try:
+        completion = request_completion(
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": SUMMARY_BATCH_PROMPT_TEMPLATE.format(
+                    count=len(batch), emails=json.dumps(batch, ensure_ascii=False)
+                )}
+            ],
+            max_tokens=300 * len(batch),
+            temperature=0.4,
+            model=SUMMARY_MODEL,
+            response_format={"type": "json_object"}
+        )
+        summaries = {
+            str(entry.get('id')): entry.get('summary')
+            for entry in json.loads(completion.choices[0].message.content).get('summaries', [])
+            if isinstance(entry, dict)
+        }
+    except Exception:
+        logging.exception("Error generating batch summary")
+        summaries = {}
+
+    results = [summaries.get(email['id']) for email in batch]
+    results = [summary if isinstance(summary, str) and summary.strip() else None for summary in results]
+    logging.info(f"Batch of {len(batch)} emails summarized, {results.count(None)} missing from the reply")
+    return results
+
+summary_cache_lock = threading.Lock()
+summary_cache_stats = {'hits': 0, 'misses': 0}
+
+# Cache key covering everything that changes the summary: the email, the model and the prompt.
+def summary_cache_key(email_text, email_from, email_date):
+    key_data = json.dumps(
+        [
+            SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, SUMMARY_PROMPT_TEMPLATE, SUMMARY_CHUNK_PROMPT_TEMPLATE,
+            SUMMARY_BATCH_PROMPT_TEMPLATE, SUMMARY_INPUT_TOKEN_BUDGET, email_from, email_date, email_text
+        ],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+def read_cache(cache_dir, key):
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            summary = json.load(f)['summary']
+        os.utime(cache_path)  # Mark as recently used for eviction
+        return summary
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.error(f"Error reading cache entry {cache_path}: {e}")
+        return None
 
-                    email_text = email_data.get('stripped_text', '')
-                    email_from = email_data.get('from', 'Unknown sender')
-                    email_date = email_data.get('date', 'Unknown date')
+def write_cache(cache_dir, key, summary):
+    save_to_json(
+        os.path.join(cache_dir, f"{key}.json"),
+        {'summary': summary, 'created': time.time()},
+        f"Cached under {key} in {cache_dir}"
+    )
 
-                    if email_text:
-                        summary = generate_summary(email_text, email_from, email_date)
+# Summarize an email, reusing the cached summary when the same email was summarized before.
+# prepared is True when quoted replies and footers were already removed from the text.
+def cached_generate_summary(email_text, email_from, email_date, prepared=False):
+    key = summary_cache_key(email_text, email_from, email_date)
+    summary = read_cache(SUMMARY_CACHE_DIR, key)
 
-                        if summary:
-                            summary_file.write(f"Email: {email_file}\nSummary:\n {summary}\n\n---\n")
-                            logging.info(f"Summary for {email_file} written to {SUMMARY_FILE_PATH}")
-                        else:
-                            logging.warning(f"Could not generate summary for {email_file}")
-                    else:
-                        logging.warning(f"No text found in {email_file}, skipping...")
-            except Exception as e:
-                logging.error(f"Error processing {email_file}: {e}")
+    with summary_cache_lock:
+        summary_cache_stats['hits' if summary else 'misses'] += 1
+    if summary:
+        return summary
 
-# Format email summaries for TTS.
+    summary = generate_summary(email_text if prepared else prepare_email_text(email_text), email_from, email_date)
+    if summary:
+        write_cache(SUMMARY_CACHE_DIR, key, summary)
+    return summary
+
+# Delete cache entries that are too old, then the least recently used ones past the size limit.
+def evict_cache(cache_dir):
+    oldest_allowed = time.time() - SUMMARY_CACHE_MAX_AGE_DAYS * 86400
+    entries = []
+
+    for file_name in os.listdir(cache_dir):
+        cache_path = os.path.join(cache_dir, file_name)
+        try:
+            last_used = os.path.getmtime(cache_path)
+            if last_used < oldest_allowed:
+                os.remove(cache_path)
+            else:
+                entries.append((last_used, cache_path))
+        except OSError as e:
+            logging.error(f"Error evicting cache entry {cache_path}: {e}")
+
+    entries.sort()
+    for _, cache_path in entries[:max(len(entries) - SUMMARY_CACHE_MAX_ENTRIES, 0)]:
+        try:
+            os.remove(cache_path)
+        except OSError as e:
+            logging.error(f"Error evicting cache entry {cache_path}: {e}")
+
+# Text of a pipeline row that is sent for summarizing. Merged threads were trimmed reply by
+# reply when they were merged, trimming them again could cut off the later replies.
+def summary_text(row):
+    return row['stripped_text'] if row.get('prepared') else prepare_email_text(row['stripped_text'])
+
+# Summarize one stored email. Returns None when the summary could not be generated.
+def summarize_stored_email(row):
+    summary = cached_generate_summary(
+        row['stripped_text'], row['sender'] or 'Unknown sender', row['date'] or 'Unknown date', row.get('prepared', False)
+    )
+    if not summary:
+        logging.warning(f"Could not generate summary for {row['id']}")
+    return summary
+
+# Summarize stored emails, returning the summaries in the same order. Emails that are not
+# cached are sent in one batch request, and any the batch misses are summarized on their own.
+def summarize_stored_emails(rows):
+    if len(rows) == 1:
+        return [summarize_stored_email(rows[0])]
+
+    emails = [(summary_text(row), row['sender'] or 'Unknown sender', row['date'] or 'Unknown date') for row in rows]
+    # Keyed on the stored text, the same as cached_generate_summary()
+    keys = [summary_cache_key(row['stripped_text'], *email[1:]) for row, email in zip(rows, emails)]
+    summaries = [read_cache(SUMMARY_CACHE_DIR, key) for key in keys]
+    missing = [index for index, summary in enumerate(summaries) if not summary]
+    with summary_cache_lock:
+        summary_cache_stats['hits'] += len(rows) - len(missing)
+        summary_cache_stats['misses'] += len(missing)
+
+    batched = len(missing) > 1
+    if batched:
+        batch_summaries = generate_batch_summaries([emails[index] for index in missing])
+    else:
+        batch_summaries = [generate_summary(*emails[index]) for index in missing]
+
+    for index, summary in zip(missing, batch_summaries):
+        # Emails the batch left out get a request of their own
+        if not summary and batched:
+            summary = generate_summary(*emails[index])
+        if summary:
+            write_cache(SUMMARY_CACHE_DIR, keys[index], summary)
+        else:
+            logging.warning(f"Could not generate summary for {rows[index]['id']}")
+        summaries[index] = summary
+    return summaries
+
+# Groups short emails into batches of at most SUMMARY_BATCH_MAX_EMAILS emails and
+# SUMMARY_BATCH_TOKEN_BUDGET tokens, so shorter emails make larger batches.
+class SummaryBatcher:
+    def __init__(self):
+        self.batch = []
+        self.tokens = 0
+
+    # Add an item. When it starts a new batch the previous batch is returned, which is
+    # empty for the first item, otherwise None.
+    def add(self, item, tokens):
+        closed = None
+        if not self.batch or self.tokens + tokens > SUMMARY_BATCH_TOKEN_BUDGET or len(self.batch) >= SUMMARY_BATCH_MAX_EMAILS:
+            closed = self.flush()
+        self.batch.append(item)
+        self.tokens += tokens
+        return closed
+
+    def flush(self):
+        batch = self.batch
+        self.batch = []
+        self.tokens = 0
+        return batch
+
+# Combine the emails of a thread, oldest first, into one email under the newest message.
+# Quoted history is removed from each email, so every reply appears once.
+def merge_thread(rows):
+    rows = sorted(rows, key=lambda row: parse_email_date(row['date'] or '') or 0)
+    parts = [
+        f"Message from {row['sender'] or 'Unknown sender'} on {row['date'] or 'Unknown date'}: {prepare_email_text(row['stripped_text'])}"
+        for row in rows if row['stripped_text']
+    ]
+    senders = dict.fromkeys(row['sender'] for row in rows if row['sender'])
+    return {
+        'id': rows[-1]['id'],
+        'stripped_text': "\n\n".join(parts),
+        'sender': ", ".join(senders),
+        'date': rows[-1]['date'],
+        'members': [row['id'] for row in rows[:-1]],
+        'prepared': True,
+    }
+
+MINHASH_SIZE = 64
+MINHASH_BAND_SIZE = 4 # 16 bands of 4, emails about half as similar as the threshold become candidates
+SHINGLE_WORDS = 5
+
+# MinHash signature of the word shingles, with one hash per shingle spread over
+# MINHASH_SIZE bins. Words are hashed with crc32 and shingles as tuples of those ints,
+# which unlike string hashes are the same in every run. Empty bins borrow the next
+# filled bin so short texts still get a full signature.
+def minhash_signature(words):
+    word_hashes = [zlib.crc32(word.encode('utf-8')) for word in words]
+    shingles = set(zip(*(word_hashes[start:] for start in range(SHINGLE_WORDS)))) or {tuple(word_hashes)}
+
+    # The first value of each bin in sorted order is its minimum
+    bins = [None] * MINHASH_SIZE
+    filled_count = 0
+    for value in sorted(hash(shingle) & 0xFFFFFFFFFFFFFFFF for shingle in shingles):
+        index = value % MINHASH_SIZE
+        if bins[index] is None:
+            bins[index] = value
+            filled_count += 1
+            if filled_count == MINHASH_SIZE:
+                break
+
+    filled = [index for index, value in enumerate(bins) if value is not None]
+    for index in range(MINHASH_SIZE):
+        if bins[index] is None:
+            borrowed = next((filled_index for filled_index in filled if filled_index > index), filled[0])
+            bins[index] = (bins[borrowed], (borrowed - index) % MINHASH_SIZE)
+    return tuple(bins)
+
+# Finds emails whose text is nearly the same as an email added before, such as the same
+# newsletter sent to several addresses. Locality sensitive hashing on the MinHash bands
+# means each email is only compared with likely matches.
+class DuplicateIndex:
+    def __init__(self):
+        self.signatures = {}
+        self.bands = {}
+
+    # Return the ID of an earlier near duplicate of the text, or add the text and return None.
+    # email_text is the text sent for summarizing, see summary_text().
+    def find_or_add(self, message_id, email_text):
+        words = email_text.lower().split()[:NEAR_DUPLICATE_MAX_WORDS]
+        if len(words) < NEAR_DUPLICATE_MIN_WORDS:
+            return None
+
+        signature = minhash_signature(words)
+        band_keys = [(start, signature[start:start + MINHASH_BAND_SIZE]) for start in range(0, MINHASH_SIZE, MINHASH_BAND_SIZE)]
+        candidates = dict.fromkeys(candidate for key in band_keys for candidate in self.bands.get(key, ()))
+        for candidate in candidates:
+            matches = sum(a == b for a, b in zip(signature, self.signatures[candidate]))
+            if matches / MINHASH_SIZE >= NEAR_DUPLICATE_THRESHOLD:
+                return candidate
+
+        self.signatures[message_id] = signature
+        for key in band_keys:
+            self.bands.setdefault(key, []).append(message_id)
+        return None
+
+# Summarizes emails on a thread pool while the caller keeps producing them. At most
+# PIPELINE_QUEUE_SIZE emails wait for a summary at once, submit() blocks when it is full.
+# Results are saved to the store from the caller's thread, since the connection is not shared.
+class SummaryPipeline:
+    def __init__(self, conn, concurrency=SUMMARY_CONCURRENCY):
+        self.conn = conn
+        self.executor = ThreadPoolExecutor(max_workers=max(concurrency, 1))
+        self.slots = threading.BoundedSemaphore(PIPELINE_QUEUE_SIZE)
+        self.batcher = SummaryBatcher()
+        self.duplicate_index = DuplicateIndex()
+        self.thread_sizes = Counter()
+        self.threads = {}
+        self.waiting_duplicates = {}  # Original ID to the IDs of its duplicates, until the original is summarized
+        self.outcomes = {}  # Original ID to whether it was summarized
+        self.pending = deque()
+        self.summarized = 0
+        self.failed = 0
+        self.duplicates = 0
+
+    # Set how many of the emails about to be submitted belong to each thread. The emails of
+    # a thread are held back until they have all arrived, then summarized together.
+    def expect_threads(self, thread_ids):
+        if GROUP_THREADS:
+            self.thread_sizes.update(thread_id for thread_id in thread_ids if thread_id)
+
+    def submit(self, message_id, email_text, email_from, email_date, token_count=None, thread_id=None):
+        row = {'id': message_id, 'stripped_text': email_text, 'sender': email_from, 'date': email_date}
+        if self.thread_sizes.get(thread_id, 0) > 1:
+            thread = self.threads.setdefault(thread_id, [])
+            thread.append(row)
+            if len(thread) < self.thread_sizes[thread_id]:
+                return
+            row, token_count = merge_thread(self.threads.pop(thread_id)), None
+        self.add(row, token_count)
+
+    # Short emails wait in the batcher until their batch is full or the pipeline closes.
+    def add(self, row, token_count=None):
+        message_ids = [row['id']] + row.get('members', [])
+        if not row['stripped_text']:
+            for message_id in message_ids:
+                save_summary_status(self.conn, message_id, 'empty')
+            return
+
+        email_text = summary_text(row)
+        original_id = self.duplicate_index.find_or_add(row['id'], email_text)
+        if original_id in self.outcomes:
+            duplicates, results = self.resolve_duplicates(original_id, message_ids, self.outcomes[original_id])
+            save_summaries(self.conn, results)
+            save_duplicates(self.conn, duplicates)
+            return
+        if original_id:
+            self.waiting_duplicates.setdefault(original_id, []).extend(message_ids)
+            return
+
+        if len(self.batcher.batch) >= PIPELINE_QUEUE_SIZE:
+            self.start(self.batcher.flush())  # The waiting batch holds every slot, nothing would free one
+        self.slots.acquire()
+
+        if token_count is None and SUMMARY_BATCHING:
+            token_count = count_tokens(email_text)
+        if SUMMARY_BATCHING and token_count <= SUMMARY_BATCH_EMAIL_MAX_TOKENS:
+            self.start(self.batcher.add(row, token_count + BATCH_EMAIL_OVERHEAD_TOKENS))
+        else:
+            self.start([row])
+        self.save_finished()
+
+    def start(self, rows):
+        if not rows:
+            return
+        future = self.executor.submit(summarize_stored_emails, rows)
+        future.add_done_callback(lambda _: self.release_slots(len(rows)))
+        self.pending.append((rows, future))
+
+    def release_slots(self, count):
+        for _ in range(count):
+            self.slots.release()
+
+    # Duplicates of an original are only marked once it is summarized. When it failed they
+    # fail with it, so they are tried again with the other failed emails. Returns the
+    # duplicates and results to save.
+    def resolve_duplicates(self, original_id, message_ids, summarized):
+        if not summarized:
+            return [], [(message_id, None) for message_id in message_ids]
+        self.duplicates += len(message_ids)
+        metrics.add('summary_duplicates', len(message_ids))
+        return [(message_id, original_id) for message_id in message_ids], []
+
+    # Save the summaries that have finished so far, in submission order. The other emails
+    # of a summarized thread and the near duplicates are saved as duplicates of it.
+    def save_finished(self, block=False):
+        results = []
+        duplicates = []
+        while self.pending and (block or self.pending[0][1].done()):
+            rows, future = self.pending.popleft()
+            for row, summary in zip(rows, future.result()):
+                results.append((row['id'], summary))
+                if summary:
+                    self.summarized += 1
+                else:
+                    self.failed += 1
+                self.outcomes[row['id']] = bool(summary)
+                message_ids = row.get('members', []) + self.waiting_duplicates.pop(row['id'], [])
+                row_duplicates, row_results = self.resolve_duplicates(row['id'], message_ids, bool(summary))
+                duplicates += row_duplicates
+                results += row_results
+            if len(results) >= STORE_WRITE_BATCH_SIZE:
+                save_summaries(self.conn, results)
+                results = []
+        save_summaries(self.conn, results)
+        save_duplicates(self.conn, duplicates)
+
+    def close(self):
+        # Threads that are still missing emails, which failed to download or were skipped
+        for rows in self.threads.values():
+            self.add(merge_thread(rows) if len(rows) > 1 else rows[0])
+        self.threads = {}
+        self.start(self.batcher.flush())
+        self.save_finished(block=True)
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def save_summary_status(conn, message_id, status):
+    with conn:
+        conn.execute("UPDATE messages SET summary_status = ? WHERE id = ?", (status, message_id))
+
+# Emails whose original was deleted or fell out of the timeframe get summarized themselves.
+def requeue_orphaned_duplicates(conn):
+    with conn:
+        count = conn.execute(
+            "UPDATE messages SET summary_status = 'pending', duplicate_of = NULL "
+            "WHERE summary_status = 'duplicate' AND duplicate_of NOT IN (SELECT id FROM messages)"
+        ).rowcount
+    if count:
+        logging.info(f"{count} emails lost the email they duplicate and will be summarized")
+    return count
+
+def save_duplicates(conn, duplicates):
+    with conn:
+        conn.executemany(
+            "UPDATE messages SET summary = NULL, summary_status = 'duplicate', duplicate_of = ? WHERE id = ?",
+            [(original_id, message_id) for message_id, original_id in duplicates]
+        )
+
+def save_summaries(conn, results):
+    with conn:
+        conn.executemany(
+            "UPDATE messages SET summary = ?, summary_status = ? WHERE id = ?",
+            [(summary, 'done' if summary else 'failed', message_id) for message_id, summary in results]
+        )
+
+# Write every stored summary to the summary file, oldest email first.
+def write_summary_file(conn):
+    rows = conn.execute("SELECT id, summary FROM messages WHERE summary_status = 'done' ORDER BY date_ts, id")
+    with open(SUMMARY_FILE_PATH, 'w', encoding='utf-8') as summary_file:
+        for row in rows:
+            summary_file.write(f"Email: {row['id']}\nSummary:\n {row['summary']}\n\n---\n")
+    logging.info(f"Summaries written to {SUMMARY_FILE_PATH}")
+
+# Stream the stored emails and their summaries to a file with one JSON object per line,
+# oldest first. Rows are read and written one at a time, so memory use stays flat however
+# many emails are stored. Paths ending in .gz are written gzip compressed.
+def export_emails(path, include_body=True):
+    columns = "id, thread_id, sender, subject, date, summary_status, summary, duplicate_of"
+    if include_body:
+        columns += ", body"
+
+    open_output = gzip.open if path.endswith('.gz') else open
+    count = 0
+    with closing(open_store()) as conn, open_output(path, 'wt', encoding='utf-8') as output:
+        for row in conn.execute(f"SELECT {columns} FROM messages ORDER BY date_ts, id"):
+            output.write(json.dumps(dict(row), ensure_ascii=False, separators=(',', ':')) + "\n")
+            count += 1
+    logging.info(f"Exported {count} emails to {path}")
+    return count
+
+# Summarize stored emails that have no summary yet, in date order. Returns the number of
+# emails summarized, the number that failed and the number skipped as duplicates.
+def summarize_pending_emails(conn, concurrency=SUMMARY_CONCURRENCY, retry_failed=True):
+    statuses = ('pending', 'failed') if retry_failed else ('pending',)
+    rows = conn.execute(
+        "SELECT id, thread_id, sender, date, stripped_text, token_count FROM messages "
+        f"WHERE summary_status IN ({', '.join('?' * len(statuses))}) AND stripped_text IS NOT NULL ORDER BY date_ts, id",
+        statuses
+    ).fetchall()
+    logging.info(f"Found {len(rows)} emails to summarize")
+
+    with SummaryPipeline(conn, concurrency) as pipeline:
+        pipeline.expect_threads(row['thread_id'] for row in rows)
+        for row in rows:
+            pipeline.submit(row['id'], row['stripped_text'], row['sender'], row['date'], row['token_count'], row['thread_id'])
+    return pipeline.summarized, pipeline.failed, pipeline.duplicates
+
+# Log the cache use of this run, write the summary file and return the cache counts.
+def finish_summaries(conn):
+    logging.info(f"Summary cache: {summary_cache_stats['hits']} hits, {summary_cache_stats['misses']} misses")
+    evict_cache(SUMMARY_CACHE_DIR)
+    write_summary_file(conn)
+    return {'cache_hits': summary_cache_stats['hits'], 'cache_misses': summary_cache_stats['misses']}
+
+# Summarize every stored email that has no summary yet, then rewrite the summary file.
+# The file is written from the store in date order, so the output is the same whether
+# the emails are summarized one by one or in parallel.
+def process_emails(concurrency=SUMMARY_CONCURRENCY):
+    with closing(open_store()) as conn:
+        estimate = estimate_pending_summaries(conn)
+        logging.info(
+            f"Summarizing {estimate['emails']} emails, at most {estimate['input_tokens']} input tokens "
+            f"in {estimate['requests']} requests"
+        )
+        summary_cache_stats.update(hits=0, misses=0)
+        summarized, failed, duplicates = summarize_pending_emails(conn, concurrency)
+        return {'summarized': summarized, 'summary_failures': failed, 'duplicates': duplicates, **finish_summaries(conn)}
+
+GROUP_DIGEST_PROMPT = (
+    "The following are summaries of several emails from {sender}. Combine them into a single short digest of everything this sender said. "
+    "Keep every action, key point and deadline, merge points that repeat, and quote directly where the summaries quote.\n\n{summaries}"
+)
+MERGE_DIGEST_PROMPT = (
+    "The following are digests of emails from different senders. Combine them into one digest that keeps the sender of every point. "
+    "Keep every action, key point and deadline, and merge points that different senders repeat.\n\n{digests}"
+)
+TTS_BRIEF_PROMPT = (
+    "You are a personal assistant tasked with converting email summaries into an engaging narrative brief. Begin with a friendly greeting, then seamlessly summarize the most important points from each email in a conversational tone that feels like a relaxed chat. Highlight key information clearly and concisely, ensuring the reader easily grasps the main takeaways. When mentioning the sender or source of each email, weave it naturally into the narrative. If multiple emails discuss the same topic or share similar details, consolidate the information into a single, cohesive point, ensuring no repetition. Avoid including email dates or special characters (e.g., *, @, etc.). Focus on clarity and readability, keeping the entire brief concise while emphasizing the essential details."
+)
+
+# Send a digest prompt, reusing the cached result when the exact same prompt was sent before.
+def cached_digest_completion(prompt, max_tokens):
+    key = hashlib.sha256(json.dumps([SUMMARY_MODEL, prompt, max_tokens]).encode('utf-8')).hexdigest()
+    digest = read_cache(DIGEST_CACHE_DIR, key)
+    if digest:
+        return digest
+
+    completion = request_completion(
+        messages=[
+            {"role": "system", "content": "You are a personal assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        temperature=0.4,
+        model=SUMMARY_MODEL
+    )
+    digest = completion.choices[0].message.content
+    write_cache(DIGEST_CACHE_DIR, key, digest)
+    return digest
+
+# Group the summaries by sender address, in the order each sender first appears.
+def group_summaries_by_sender(rows):
+    groups = {}
+    for row in rows:
+        sender = parseaddr(row['sender'] or '')[1].lower() or row['sender'] or 'Unknown sender'
+        groups.setdefault(sender, []).append(row['summary'])
+    return list(groups.items())
+
+# Reduce one sender's summaries to a single digest. A sender with one email keeps its summary.
+# Digests are cached, so a new email only recomputes the digest of its sender.
+def build_group_digest(group):
+    sender, summaries = group
+    if len(summaries) == 1:
+        digest = summaries[0]
+    else:
+        digest = cached_digest_completion(
+            GROUP_DIGEST_PROMPT.format(sender=sender, summaries="\n\n---\n".join(summaries)),
+            max_tokens=500
+        )
+    return f"From {sender}:\n{digest}"
+
+def merge_digest_batch(digests):
+    if len(digests) == 1:
+        return digests[0]
+    return cached_digest_completion(MERGE_DIGEST_PROMPT.format(digests="\n\n---\n".join(digests)), max_tokens=1000)
+
+# Merge digests in rounds until they fit in DIGEST_MERGE_TOKEN_BUDGET.
+def merge_digests(digests, executor):
+    while len(digests) > 1 and sum(count_tokens(digest) for digest in digests) > DIGEST_MERGE_TOKEN_BUDGET:
+        batches, batch, batch_tokens = [], [], 0
+        for digest in digests:
+            tokens = count_tokens(digest)
+            if batch and batch_tokens + tokens > DIGEST_MERGE_TOKEN_BUDGET:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(digest)
+            batch_tokens += tokens
+        batches.append(batch)
+
+        if len(batches) == len(digests):
+            # Every digest is over the budget on its own, merging cannot shrink them further
+            break
+        logging.info(f"Merging {len(digests)} digests into {len(batches)}")
+        digests = list(executor.map(merge_digest_batch, batches))
+    return digests
+
+# Format email summaries for TTS. Summaries are reduced per sender in parallel, the sender
+# digests are merged down to the budget and the result is turned into the narrative brief.
 def format_for_tts():
-    if not os.path.exists(SUMMARY_FILE_PATH):
-        logging.error(f"The summary file does not exist: {SUMMARY_FILE_PATH}")
-        return
+    with closing(open_store()) as conn:
+        rows = conn.execute(
+            "SELECT sender, summary FROM messages WHERE summary_status = 'done' ORDER BY date_ts, id"
+        ).fetchall()
 
-    with open(SUMMARY_FILE_PATH, 'r', encoding='utf-8') as summary_file:
-        summaries = summary_file.read()
+    if not rows:
+        logging.error("No email summaries found, run Get Text Summary first")
+        return False
 
     logging.debug("Formatting email summaries for TTS")
-    prompt = (
-        "You are a personal assistant tasked with converting email summaries into an engaging narrative brief. Begin with a friendly greeting, then seamlessly summarize the most important points from each email in a conversational tone that feels like a relaxed chat. Highlight key information clearly and concisely, ensuring the reader easily grasps the main takeaways. When mentioning the sender or source of each email, weave it naturally into the narrative. If multiple emails discuss the same topic or share similar details, consolidate the information into a single, cohesive point, ensuring no repetition. Avoid including email dates or special characters (e.g., *, @, etc.). Focus on clarity and readability, keeping the entire brief within 4700 characters while emphasizing the essential details." + summaries
-    )
 
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini", 
-            messages=[
-                {"role": "system", "content": "You are a personal assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1000,
-            temperature=0.4  
-        )
+        groups = group_summaries_by_sender(rows)
+        logging.info(f"Building digests for {len(groups)} senders from {len(rows)} summaries")
+
+        with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY) as executor:
+            digests = list(executor.map(build_group_digest, groups))
+            digests = merge_digests(digests, executor)
 
-        formatted_summary = completion.choices[0].message.content
+        formatted_summary = cached_digest_completion(TTS_BRIEF_PROMPT + "\n\n" + "\n\n".join(digests), max_tokens=1000)
 
         with open(TTS_OUTPUT_FILE_PATH, 'w', encoding='utf-8') as tts_file:
             tts_file.write(formatted_summary)
 
         logging.info(f"Formatted summary for TTS has been saved to {TTS_OUTPUT_FILE_PATH}")
+        return True
 
     except Exception as e:
         logging.exception("Error generating formatted summary for TTS")
+        return False
+
+    finally:
+        evict_cache(DIGEST_CACHE_DIR)
 
 # Curently not being used, need to work on the ssml voices
 def convert_text_to_ssml():
@@ -409,42 +2086,136 @@ def convert_text_to_ssml():
 
     return SSML_OUTPUT_FILE_PATH
 
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+# Split a word into pieces of at most max_bytes UTF-8 bytes, without splitting a character.
+def split_utf8(word, max_bytes):
+    encoded = word.encode('utf-8')
+    pieces = []
+    while len(encoded) > max_bytes:
+        cut = max_bytes
+        while encoded[cut] & 0xC0 == 0x80:  # Continuation byte, move back to the start of the character
+            cut -= 1
+        pieces.append(encoded[:cut].decode('utf-8'))
+        encoded = encoded[cut:]
+    pieces.append(encoded.decode('utf-8'))
+    return pieces
+
+# Split text into pieces under TTS_MAX_CHUNK_BYTES, breaking between sentences where possible.
+# Pieces end at every line break and after about one in TTS_SEGMENT_SENTENCES sentences,
+# picked by the text of the sentence itself. The pieces, and so their cached audio, then
+# only change around an edit instead of every piece after it moving along.
+def split_for_tts(text):
+    chunks = []
+    for paragraph in text.split('\n'):
+        pieces = []
+        for sentence in SENTENCE_END.split(paragraph.strip()):
+            if not sentence:
+                continue
+            ends_segment = zlib.crc32(sentence.encode('utf-8')) % TTS_SEGMENT_SENTENCES == 0
+            if len(sentence.encode('utf-8')) <= TTS_MAX_CHUNK_BYTES:
+                pieces.append((sentence, ends_segment))
+                continue
+            # A single sentence over the limit is split between words, and a word over the limit
+            # (such as a long URL) by bytes
+            words = [piece for word in sentence.split() for piece in split_utf8(word, TTS_MAX_CHUNK_BYTES)]
+            pieces.extend((word, ends_segment and index == len(words) - 1) for index, word in enumerate(words))
+
+        current, current_bytes = '', 0
+        for piece, ends_segment in pieces:
+            piece_bytes = len(piece.encode('utf-8'))
+            if current and current_bytes + 1 + piece_bytes > TTS_MAX_CHUNK_BYTES:
+                chunks.append(current)
+                current, current_bytes = '', 0
+            if current:
+                current, current_bytes = f"{current} {piece}", current_bytes + 1 + piece_bytes
+            else:
+                current, current_bytes = piece, piece_bytes
+            if ends_segment:
+                chunks.append(current)
+                current, current_bytes = '', 0
+        if current:
+            chunks.append(current)
+    return chunks
+
+# Synthesize one chunk of text, reusing the cached audio when the same text was spoken before.
+def synthesize_segment(text):
+    from google.cloud import texttospeech
+
+    key_data = json.dumps([TTS_LANGUAGE_CODE, TTS_VOICE_NAME, 'MP3', text], ensure_ascii=False)
+    cache_path = os.path.join(TTS_CACHE_DIR, f"{hashlib.sha256(key_data.encode('utf-8')).hexdigest()}.mp3")
+
+    # Empty files are skipped, they can be left by a crash in older versions
+    if os.path.exists(cache_path) and os.path.getsize(cache_path) > 0:
+        os.utime(cache_path)  # Mark as recently used for eviction
+        metrics.add('tts_cache_hits')
+        with open(cache_path, 'rb') as f:
+            return f.read()
+
+    with metrics.timer('tts_request'):
+        response = services.tts.synthesize_speech(
+            input=texttospeech.SynthesisInput(text=text),
+            voice=texttospeech.VoiceSelectionParams(
+                language_code=TTS_LANGUAGE_CODE,
+                name=TTS_VOICE_NAME,  # en-US-Journey-F
+                ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
+            ),
+            audio_config=texttospeech.AudioConfig(
+                audio_encoding=texttospeech.AudioEncoding.MP3
+            )
+        )
+    metrics.add('tts_requests')
+    metrics.add('tts_bytes_out', len(text.encode('utf-8')))
+    metrics.add('tts_audio_bytes', len(response.audio_content))
+
+    # Write to a temporary file first, so a crash or another thread speaking the same
+    # text never leaves a partial file in the cache
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(response.audio_content)
+    os.replace(tmp_path, cache_path)
+    return response.audio_content
+
+# Convert the formatted brief to speech. The brief is split on sentence boundaries into
+# chunks under the request size limit, which are synthesized in parallel and joined in order.
+# Only the chunks that changed since the last brief are sent, the rest come from the cache.
 def text_to_speech():
     if not os.path.exists(TTS_OUTPUT_FILE_PATH):
         logging.error(f"The TTS input file does not exist: {TTS_OUTPUT_FILE_PATH}")
-        return
+        return False
 
     with open(TTS_OUTPUT_FILE_PATH, 'r', encoding='utf-8') as file:
         text = file.read()
 
-    client = texttospeech.TextToSpeechClient.from_service_account_file(SERVICE_ACCOUNT_PATH)
+    chunks = split_for_tts(text)
+    logging.info(f"Synthesizing {len(chunks)} audio segments")
 
-    synthesis_input = texttospeech.SynthesisInput(text=text)
-    voice = texttospeech.VoiceSelectionParams(
-        language_code="en-US",
-        name="en-US-Journey-F",  # en-US-Journey-F
-        ssml_gender=texttospeech.SsmlVoiceGender.FEMALE 
-    )
-    audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.MP3 
-    )
-
-    response = client.synthesize_speech(
-        input=synthesis_input, voice=voice, audio_config=audio_config
-    )
+    with ThreadPoolExecutor(max_workers=TTS_CONCURRENCY) as executor:
+        segments = list(executor.map(synthesize_segment, chunks))
 
+    # MP3 files are a sequence of independent frames, so the segments can be joined directly
     with open(TTS_AUDIO_OUTPUT_FILE_PATH, 'wb') as output:
-        output.write(response.audio_content)
+        for segment in segments:
+            output.write(segment)
         logging.info(f"TTS audio saved to: {TTS_AUDIO_OUTPUT_FILE_PATH}")
 
+    evict_cache(TTS_CACHE_DIR)
+    return True
+
+
+# Sign in to Gmail the first time a menu action needs it, so the summary and audio actions
+# start without loading the Google libraries. Returns None when signing in failed.
+def get_gmail():
+    if not services.creds:
+        services.authenticate()
+    return services.gmail
 
 def main():
+    configure_logging()
+    ensure_directories()
+
     exit_program = False
-    creds = None
-    service = None
     timeframe_hours = 24
-    creds = gmail_authenticate()
-    service = build('gmail', 'v1', credentials=creds)
 
     while not exit_program:
         clear_screen()
@@ -452,8 +2223,12 @@ def main():
 
         if current_menu == 1:
             clear_screen()
-            if os.path.exists(SUMMARY_FILE_PATH):
-                os.remove(SUMMARY_FILE_PATH)
+            with closing(open_store()) as conn:
+                estimate = estimate_pending_summaries(conn)
+            print(
+                f"Summarizing {estimate['emails']} emails "
+                f"(up to {estimate['input_tokens']} input tokens in {estimate['requests']} requests)..."
+            )
             process_emails()
         elif current_menu == 2:
             clear_screen()
@@ -462,34 +2237,33 @@ def main():
             text_to_speech()
         elif current_menu == 3:
             clear_screen()
-            if os.path.exists(EMAILS_JSON_PATH):
-                os.remove(EMAILS_JSON_PATH)
-                print(f"Deleted old {EMAILS_JSON_PATH}.")
-
+            service = get_gmail()
             if service:
-                print(f"Fetching emails from the past {timeframe_hours} hours...")
-                emails = get_emails_within_timeframe(service, timeframe_hours)
-                save_emails_to_json(emails)
-                print(f"Fetched and saved {len(emails)} emails.")
-
-                if os.path.exists(EMAILS_SUBDIR):
-                    for file_name in os.listdir(EMAILS_SUBDIR):
-                        file_path = os.path.join(EMAILS_SUBDIR, file_name)
-                        try:
-                            if os.path.isfile(file_path):
-                                os.unlink(file_path)
-                        except Exception as e:
-                            print(f"Failed to delete {file_name}: {e}")
-
-                strip_emails()
-
-                if os.path.exists(EMAILS_JSON_PATH):
-                    os.remove(EMAILS_JSON_PATH)
-                    print(f"{EMAILS_JSON_PATH} has been deleted after processing.")
+                print(f"Updating emails from the past {timeframe_hours} hours...")
+                try:
+                    result = sync_emails(service, timeframe_hours)
+                    print(f"Email store updated: {result['added']} new, {result['removed']} removed.")
+                except Exception as e:
+                    print(f"Failed to update emails: {e}")
             else:
                 print("Please authenticate with Gmail first.")
-
         elif current_menu == 4:
+            clear_screen()
+            service = get_gmail()
+            if service:
+                print(f"Updating and summarizing emails from the past {timeframe_hours} hours...")
+                try:
+                    result = sync_emails(service, timeframe_hours, summarize=True)
+                    print(
+                        f"Email store updated: {result['added']} new, {result['removed']} removed. "
+                        f"Summaries saved to {SUMMARY_FILE_PATH}"
+                    )
+                except Exception as e:
+                    print(f"Failed to update emails: {e}")
+            else:
+                print("Please authenticate with Gmail first.")
+
+        elif current_menu == 5:
             while True:
                 clear_screen()
                 submenu = settings_menu()
@@ -506,14 +2280,223 @@ def main():
                     print(f"Timeframe set to the past {timeframe_hours} hours.")
                 elif submenu == 2:
                     clear_screen()
-                    creds = gmail_authenticate()
-                    service = build('gmail', 'v1', credentials=creds)
+                    services.authenticate()
                     print("Successfully linked to Gmail.")
                 elif submenu == 3:
+                    clear_screen()
+                    service = get_gmail()
+                    if service:
+                        print(f"Downloading all emails from the past {timeframe_hours} hours...")
+                        try:
+                            result = sync_emails(service, timeframe_hours, full=True)
+                            print(f"Fetched and saved {result['added']} emails.")
+                        except Exception as e:
+                            print(f"Failed to update emails: {e}")
+                    else:
+                        print("Please authenticate with Gmail first.")
+                elif submenu == 4:
                     break
-        elif current_menu == 5:
+        elif current_menu == 6:
             print("Exiting the program. Goodbye!")
             exit_program = True
 
+        # Timings and totals of every action so far in this session
+        if current_menu in (1, 2, 3, 4) and METRICS_ENABLED:
+            metrics.write_report(METRICS_FILE_PATH)
+
+
+# Exit codes of the command line interface, 2 is used by argparse for invalid arguments
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_AUTH_FAILURE = 3
+
+class AuthenticationError(Exception):
+    pass
+
+# Whether Gmail rejected the saved credentials, for example a revoked refresh token.
+# The Google auth library is only checked once it has been imported.
+def is_refresh_error(error):
+    exceptions = sys.modules.get('google.auth.exceptions')
+    return exceptions is not None and isinstance(error, exceptions.RefreshError)
+
+def build_cli_parser():
+    def add_output_arguments(subparser):
+        subparser.add_argument('--stats-file', help="Append the run stats as a JSON line to this file")
+        subparser.add_argument('--json', action='store_true', help="Print the run stats as JSON instead of text")
+        subparser.add_argument('--metrics-file', help="Write the stage timings, bytes and tokens of the run to this JSON file")
+        subparser.add_argument('--prometheus-file', help="Write the same metrics in the Prometheus text format to this file")
+        subparser.add_argument(
+            '--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+            help="Level of the lines written to app.log, DEBUG also logs every MIME part"
+        )
+
+    parser = argparse.ArgumentParser(
+        description="Summarize your Gmail inbox without the interactive menu. Run without arguments for the menu."
+    )
+    add_output_arguments(parser)
+    # The same options are accepted after the command. They are left unset there when not
+    # given, so a value given before the command is kept.
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    add_output_arguments(common)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_timeframe_arguments(subparser):
+        timeframe = subparser.add_mutually_exclusive_group()
+        timeframe.add_argument('--hours', type=float, default=24, help="Fetch emails from the past number of hours (default 24)")
+        timeframe.add_argument('--since', help="Fetch emails since a date or time, for example 2024-02-01 or 2024-02-01T08:00")
+
+    sync_parser = subparsers.add_parser('sync', help="Update the local email store", parents=[common])
+    add_timeframe_arguments(sync_parser)
+    sync_parser.add_argument('--full', action='store_true', help="Download the whole timeframe again")
+    sync_parser.add_argument('--summarize', action='store_true', help="Summarize new emails while they download")
+
+    summarize_parser = subparsers.add_parser('summarize', help="Summarize stored emails and write the summary file", parents=[common])
+    summarize_parser.add_argument('--concurrency', type=int, default=SUMMARY_CONCURRENCY, help="Emails summarized at the same time")
+
+    subparsers.add_parser('digest', help="Turn the summaries into the narrative brief", parents=[common])
+    subparsers.add_parser('speak', help="Convert the narrative brief to an MP3 file", parents=[common])
+
+    export_parser = subparsers.add_parser('export', help="Write the stored emails and summaries as newline delimited JSON", parents=[common])
+    export_parser.add_argument('output', help="File to write, compressed with gzip when it ends in .gz")
+    export_parser.add_argument('--no-body', action='store_true', help="Leave out the email bodies")
+
+    daemon_parser = subparsers.add_parser('daemon', help="Sync and summarize new emails on an interval", parents=[common])
+    add_timeframe_arguments(daemon_parser)
+    daemon_parser.add_argument('--interval', type=float, default=900, help="Seconds between runs (default 900)")
+    daemon_parser.add_argument('--speak', action='store_true', help="Rebuild the brief and audio when new emails arrive")
+    return parser
+
+# Convert the --hours or --since argument to a number of hours.
+def resolve_hours(args):
+    if not args.since:
+        return args.hours
+
+    since = datetime.fromisoformat(args.since)
+    if since.tzinfo is None:
+        since = since.astimezone()  # Local time, like the interactive timeframes
+    hours = (datetime.now(timezone.utc) - since).total_seconds() / 3600
+    if hours <= 0:
+        raise ValueError(f"--since {args.since} is in the future")
+    return hours
+
+def get_headless_gmail():
+    if not services.creds:
+        services.authenticate(interactive=False)
+    service = services.gmail
+    if not service:
+        raise AuthenticationError("No valid Gmail credentials, run the interactive menu once to sign in")
+    return service
+
+def run_sync(args, stats):
+    stats.update(sync_emails(get_headless_gmail(), resolve_hours(args), full=args.full, summarize=args.summarize))
+
+def run_summarize(args, stats):
+    stats.update(process_emails(args.concurrency))
+
+def run_digest(args, stats):
+    if not format_for_tts():
+        raise RuntimeError("Could not build the narrative brief, see app.log")
+
+def run_speak(args, stats):
+    if not text_to_speech():
+        raise RuntimeError("Could not convert the narrative brief to speech, see app.log")
+
+def run_export(args, stats):
+    stats['exported'] = export_emails(args.output, include_body=not args.no_body)
+
+# One daemon cycle: an incremental sync with summaries, then optionally the brief and audio.
+def run_daemon_cycle(args, stats):
+    stats.update(sync_emails(get_headless_gmail(), resolve_hours(args), summarize=True))
+    if args.speak and stats['added']:
+        run_digest(args, stats)
+        run_speak(args, stats)
+
+CLI_COMMANDS = {
+    'sync': run_sync,
+    'summarize': run_summarize,
+    'digest': run_digest,
+    'speak': run_speak,
+    'export': run_export,
+    'daemon': run_daemon_cycle,
+}
+
+# Run one command and collect its stats. Errors are recorded in the stats instead of raised.
+def run_command(args):
+    stats = {'command': args.command, 'started_at': datetime.now(timezone.utc).isoformat(), 'status': 'ok'}
+    start = time.monotonic()
+    exit_code = EXIT_OK
+
+    try:
+        CLI_COMMANDS[args.command](args, stats)
+    except AuthenticationError as e:
+        stats.update(status='error', error=str(e))
+        exit_code = EXIT_AUTH_FAILURE
+    except Exception as e:
+        if is_refresh_error(e):
+            # The refresh token was revoked while the command was running
+            logging.error(f"Error refreshing credentials: {e}")
+            stats.update(status='error', error=f"Gmail credentials could not be refreshed: {e}")
+            exit_code = EXIT_AUTH_FAILURE
+        else:
+            logging.exception(f"Error running {args.command}")
+            stats.update(status='error', error=str(e))
+            exit_code = EXIT_FAILURE
+
+    stats['duration_seconds'] = round(time.monotonic() - start, 3)
+    return stats, exit_code
+
+def report_stats(args, stats):
+    line = json.dumps(stats)
+    if args.json:
+        print(line, flush=True)
+    else:
+        details = ", ".join(f"{key}={value}" for key, value in stats.items() if key not in ('command', 'started_at'))
+        print(f"{stats['command']}: {details}", flush=True)
+
+    if args.stats_file:
+        with open(args.stats_file, 'a', encoding='utf-8') as stats_file:
+            stats_file.write(line + "\n")
+
+    # The daemon rewrites the metrics after every cycle, with the totals since it started
+    if args.metrics_file:
+        metrics.write_report(args.metrics_file, run=stats)
+    if args.prometheus_file:
+        metrics.write_prometheus(args.prometheus_file)
+
+# Run the daemon until it is interrupted or receives SIGTERM. Failed cycles are reported
+# and retried on the next interval, only authentication failures stop it.
+def run_daemon(args):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    logging.info(f"Daemon started, syncing every {args.interval} seconds")
+
+    try:
+        while not stop.is_set():
+            stats, exit_code = run_command(args)
+            report_stats(args, stats)
+            if exit_code == EXIT_AUTH_FAILURE:
+                return exit_code
+            stop.wait(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+    logging.info("Daemon stopped")
+    return EXIT_OK
+
+# Non-interactive entry point for cron, systemd and other schedulers. Returns the exit code.
+def run_cli(argv):
+    args = build_cli_parser().parse_args(argv)
+    configure_logging(args.log_level and getattr(logging, args.log_level))
+    ensure_directories()
+
+    if args.command == 'daemon':
+        return run_daemon(args)
+
+    stats, exit_code = run_command(args)
+    report_stats(args, stats)
+    return exit_code
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     main()
\ No newline at end of file
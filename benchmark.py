@@ -0,0 +1,609 @@
+# Benchmarks for the Gmail Summarizer.
+#
+# HTML extraction speed and text fidelity:
+#   python benchmark.py extract path\to\corpus
+#
+# The corpus is a folder of Gmail messages saved as JSON files, exactly as returned by
+# service.users().messages().get(userId='me', id=message_id, format='full').execute()
+#
+# Cold start import time of the menu actions and commands, measured with python -X importtime:
+#   python benchmark.py startup
+#
+# Throughput of the whole pipeline against local stand-ins for Gmail, OpenAI and
+# Text-to-Speech, so no accounts or network are needed:
+#   python benchmark.py pipeline --messages 100 1000 10000
+
+import argparse
+import base64
+import hashlib
+import html
+import json
+import os
+import quopri
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+from difflib import SequenceMatcher
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import GmailSummarizer
+
+
+# Load the payload of every saved Gmail message in the corpus folder.
+def load_corpus(corpus_dir):
+    payloads = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(corpus_dir, file_name), 'r', encoding='utf-8') as f:
+            message = json.load(f)
+        payloads.append(message.get('payload', message))
+    return payloads
+
+# Similarity of two extracted texts from 0 to 1. Words are compared so whitespace
+# differences between the extractors do not count against them.
+def text_fidelity(reference, text):
+    if not reference and not text:
+        return 1.0
+    return SequenceMatcher(None, reference.split(), text.split(), autojunk=False).ratio()
+
+def benchmark_extract(corpus_dir, repeat):
+    payloads = load_corpus(corpus_dir)
+    if not payloads:
+        print(f"No saved messages found in {corpus_dir}")
+        return
+
+    extractors = [
+        name for name in GmailSummarizer.HTML_EXTRACTORS
+        if name != 'lxml' or GmailSummarizer.import_optional('lxml.html')
+    ]
+    results = {}
+
+    for extractor in extractors:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            texts = [GmailSummarizer.extract_email_body(payload, extractor) for payload in payloads]
+        elapsed = (time.perf_counter() - start) / repeat
+        results[extractor] = (elapsed, texts)
+
+    # The original BeautifulSoup output is the reference for fidelity
+    reference_time, reference_texts = results['bs4']
+
+    print(f"{len(payloads)} messages, average of {repeat} runs\n")
+    print(f"{'Extractor':<10}{'ms/email':>10}{'Speedup':>10}{'Fidelity':>10}{'Chars':>12}")
+    for extractor, (elapsed, texts) in results.items():
+        fidelity = sum(text_fidelity(ref, text) for ref, text in zip(reference_texts, texts)) / len(texts)
+        chars = sum(len(text) for text in texts)
+        print(
+            f"{extractor:<10}{elapsed * 1000 / len(payloads):>10.3f}"
+            f"{reference_time / elapsed:>9.1f}x{fidelity:>10.3f}{chars:>12}"
+        )
+
+# Runs one entry point of the script in a new interpreter. The settings point the script at
+# a scratch folder, the menu reads its choices from the arguments, and the marker separates
+# importing the module from the imports done by the action.
+STARTUP_MARKER = 'startup benchmark: action starts'
+STARTUP_DRIVER = f"""
+import builtins, importlib, json, sys
+import GmailSummarizer
+
+settings, mode, arguments = json.loads(sys.argv[1]), sys.argv[2], sys.argv[3:]
+vars(GmailSummarizer).update(settings)
+choices = iter(arguments)
+builtins.input = lambda prompt='': next(choices)
+GmailSummarizer.clear_screen = lambda: None
+print({STARTUP_MARKER!r}, file=sys.stderr, flush=True)
+try:
+    if mode == 'menu':
+        GmailSummarizer.main()
+    elif mode == 'cli':
+        GmailSummarizer.run_cli(arguments)
+    else:
+        for module in arguments:
+            importlib.import_module(module)
+except (Exception, SystemExit) as e:
+    # The requests fail without accounts, the imports they needed are already done
+    print(f"Action stopped: {{e!r}}", file=sys.stderr)
+"""
+
+# Entry points of the script, with the menu choices or command line arguments they run.
+# The last scenario imports everything up front, the way the script did before imports
+# were made lazy.
+STARTUP_SCENARIOS = [
+    ("Menu: quit", 'menu', ['6']),
+    ("Menu: Get Text Summary", 'menu', ['1', '6']),
+    ("Menu: Get Audio Summary", 'menu', ['2', '6']),
+    ("Menu: Update Emails", 'menu', ['3', '6']),
+    ("CLI: summarize", 'cli', ['summarize']),
+    ("CLI: sync", 'cli', ['sync']),
+    ("CLI: speak", 'cli', ['speak']),
+    ("Eager imports", 'import', [
+        "google.oauth2.credentials", "google_auth_oauthlib.flow", "google.auth.transport.requests",
+        "googleapiclient.discovery", "google_auth_httplib2", "httplib2",
+        "google.cloud.texttospeech", "openai", "bs4"
+    ]),
+]
+
+# Prepare a scratch folder for the startup runs: a saved Gmail token that needs no refresh,
+# one email waiting for a summary, one summarized email and a brief to speak. Returns the
+# settings that point the script at it.
+def prepare_startup_directory(directory):
+    use_directory(directory)
+    settings = {
+        name: getattr(GmailSummarizer, name) for name in (
+            'EMAILS_DB_PATH', 'OUTPUT_DIR', 'SUMMARY_CACHE_DIR', 'DIGEST_CACHE_DIR', 'TTS_CACHE_DIR',
+            'SUMMARY_FILE_PATH', 'TTS_OUTPUT_FILE_PATH', 'TTS_AUDIO_OUTPUT_FILE_PATH', 'METRICS_FILE_PATH',
+        )
+    }
+    settings.update(
+        BASE_DIR=directory,
+        LOG_FILE_PATH=os.path.join(directory, 'app.log'),
+        TOKEN_PATH=os.path.join(directory, 'token.json'),
+        SERVICE_ACCOUNT_PATH=os.path.join(directory, 'service_account.json'),
+        MAX_RETRIES=0,
+    )
+
+    with open(settings['TOKEN_PATH'], 'w', encoding='utf-8') as token_file:
+        json.dump({
+            'token': 'startup-benchmark', 'refresh_token': 'startup-benchmark', 'client_id': 'startup-benchmark',
+            'client_secret': 'startup-benchmark', 'expiry': '2999-01-01T00:00:00Z',
+        }, token_file)
+
+    emails = [
+        GmailSummarizer.EmailRecord(
+            id=f'startup{index}', sender='Alice <alice@example.com>', subject='Budget',
+            date='Mon, 1 Jan 2024 10:00:00 +0000', body='The budget is due on Friday.',
+            stripped_text='The budget is due on Friday.', token_count=8
+        )
+        for index in range(2)
+    ]
+    with closing(GmailSummarizer.open_store()) as conn:
+        GmailSummarizer.store_emails(conn, emails)
+        GmailSummarizer.save_summaries(conn, [('startup1', 'The budget is due on Friday.')])
+
+    with open(GmailSummarizer.TTS_OUTPUT_FILE_PATH, 'w', encoding='utf-8') as brief_file:
+        brief_file.write("Good morning. The budget is due on Friday.")
+    return settings
+
+# Import times in milliseconds of one run of the driver, from -X importtime: the module
+# itself, and the top level imports made by the action after it.
+def measure_startup(settings, mode, arguments):
+    env = dict(os.environ)
+    # Every request fails straight away instead of reaching Google or OpenAI
+    env.update(HTTP_PROXY='http://127.0.0.1:9', HTTPS_PROXY='http://127.0.0.1:9')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', STARTUP_DRIVER, json.dumps(settings), mode] + arguments,
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), env=env
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    module_us, action_us, action_started = 0, 0, False
+    for line in result.stderr.splitlines():
+        if line == STARTUP_MARKER:
+            action_started = True
+        fields = line[len('import time:'):].split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        if not action_started and fields[2].strip() == 'GmailSummarizer':
+            module_us = int(fields[1])
+        # Nested imports are indented, only top level imports are added up
+        elif action_started and not fields[2][1:].startswith(' '):
+            action_us += int(fields[1])
+    return module_us / 1000, action_us / 1000
+
+def benchmark_startup(repeat):
+    print(f"Best of {repeat} cold starts\n")
+    print(f"{'Scenario':<26}{'Module ms':>12}{'Action ms':>12}{'Total ms':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        settings = prepare_startup_directory(directory)
+        for name, mode, arguments in STARTUP_SCENARIOS:
+            try:
+                runs = [measure_startup(settings, mode, arguments) for _ in range(repeat)]
+            except RuntimeError as e:
+                print(f"{name:<26}{'failed':>12}  {e}")
+                continue
+            module_ms, action_ms = min(runs, key=sum)
+            print(f"{name:<26}{module_ms:>12.1f}{action_ms:>12.1f}{module_ms + action_ms:>12.1f}")
+
+        # Release the log file so the folder can be deleted on Windows
+        GmailSummarizer.logging.shutdown()
+
+WORDS = (
+    "meeting project deadline invoice update team review budget report customer launch design release "
+    "schedule contract order shipping account security payment quarter roadmap feedback hiring office "
+    "travel event webinar offer discount subscription renewal agenda draft approval notes analysis plan"
+).split()
+SENDER_NAMES = [
+    "Alice Smith", "Bob Jones", "Carol White", "Dan Brown", "Eve Black", "Frank Green", "Grace Hall",
+    "Henry King", "Ivy Lewis", "Jack Moore", "Store News", "Weekly Digest", "Bank Alerts", "Travel Deals",
+]
+
+def make_paragraphs(rng, count):
+    return [
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))).capitalize() + "."
+        for _ in range(count)
+    ]
+
+def make_html(paragraphs):
+    body = "".join(f"<tr><td><p>{html.escape(paragraph)}</p></td></tr>" for paragraph in paragraphs)
+    return (
+        "<html><head><style>td { padding: 8px; font-family: Arial; }</style>"
+        "<script>var tracking = 1;</script></head>"
+        f"<body><table>{body}</table><p>You received this because you subscribed. Unsubscribe</p></body></html>"
+    )
+
+def make_part(mime_type, text, encoding='base64'):
+    if encoding == 'quoted-printable':
+        body = {'data': quopri.encodestring(text.encode('utf-8')).decode('ascii'), 'encoding': encoding}
+    else:
+        body = {'data': base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')}
+    body['size'] = len(body['data'])
+    return {'mimeType': mime_type, 'body': body}
+
+# Serves synthetic messages shaped like the Gmail API responses: plain text, nested
+# multipart with attachments, quoted-printable HTML and large HTML newsletters. Every
+# message is generated from the seed and its index, so runs are reproducible.
+class FakeGmail:
+    def __init__(self, message_count, latency=0.0, seed=0):
+        self.message_count = message_count
+        self.latency = latency
+        self.seed = seed
+        self.now = datetime.now(timezone.utc)
+        # Newsletters are the slowest part to generate, so a few are built up front and reused
+        rng = random.Random(f"{seed}-newsletters")
+        self.newsletters = [make_part('text/html', make_html(make_paragraphs(rng, rng.randint(300, 1500)))) for _ in range(8)]
+
+    def make_message(self, index):
+        rng = random.Random(f"{self.seed}-{index}")
+        name = rng.choice(SENDER_NAMES)
+        sender = f"{name} <{name.lower().replace(' ', '.')}@example.com>"
+        paragraphs = make_paragraphs(rng, rng.randint(1, 8))
+        text = "\n\n".join(paragraphs)
+        kind, bulk, labels = self.message_kind(index)
+
+        if kind < 0.4:
+            if rng.random() < 0.3:
+                quoted = "\n> ".join(make_paragraphs(rng, 4))
+                text += f"\n\nOn Mon, 1 Jan 2024 at 09:00, {sender} wrote:\n> {quoted}"
+            payload = make_part('text/plain', text)
+        elif kind < 0.7:
+            alternative = {
+                'mimeType': 'multipart/alternative',
+                'parts': [make_part('text/plain', text), make_part('text/html', make_html(paragraphs))],
+            }
+            attachment = {'mimeType': 'application/pdf', 'filename': 'document.pdf', 'body': {'attachmentId': str(index), 'size': 52000}}
+            payload = {'mimeType': 'multipart/mixed', 'parts': [alternative, attachment]}
+        elif kind < 0.9:
+            payload = {'mimeType': 'multipart/alternative', 'parts': [make_part('text/html', make_html(paragraphs), 'quoted-printable')]}
+        else:
+            payload = dict(self.newsletters[index % len(self.newsletters)])
+
+        date = self.now - timedelta(hours=rng.uniform(0, 23))
+        payload['headers'] = [
+            {'name': 'From', 'value': sender},
+            {'name': 'Subject', 'value': " ".join(rng.choice(WORDS) for _ in range(5)).capitalize()},
+            {'name': 'Date', 'value': format_datetime(date)},
+        ]
+        if bulk:
+            payload['headers'].append({'name': 'List-Unsubscribe', 'value': f"<mailto:unsubscribe-{index}@example.com>"})
+        return {
+            'id': f"{index:08x}",
+            'threadId': f"{index // 3:08x}",
+            'labelIds': labels,
+            'sizeEstimate': len(json.dumps(payload)),
+            'payload': payload,
+        }
+
+    # The kind of message, whether it is bulk mail and its labels. Newsletters and some other
+    # mail is bulk mail, a share of it lands in Promotions. These come from their own random
+    # stream, so the list can filter on the labels without generating the message.
+    def message_kind(self, index):
+        rng = random.Random(f"{self.seed}-{index}-kind")
+        kind = rng.random()
+        bulk = kind >= 0.9 or rng.random() < 0.3
+        labels = ['INBOX', 'CATEGORY_PROMOTIONS'] if bulk and rng.random() < 0.5 else ['INBOX']
+        return kind, bulk, labels
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return SimpleNamespace(list=lambda **kwargs: FakeRequest(lambda: {'history': [], 'historyId': '1'}))
+
+    def getProfile(self, userId):
+        return FakeRequest(lambda: {'historyId': '1'})
+
+    # Only the -category:promotions term of the search is applied, the other terms match every message.
+    def list(self, userId, q=None, maxResults=100, pageToken=None):
+        start = int(pageToken or 0)
+        end = min(start + maxResults, self.message_count)
+        indexes = range(start, end)
+        if '-category:promotions' in (q or ''):
+            indexes = [index for index in indexes if 'CATEGORY_PROMOTIONS' not in self.message_kind(index)[2]]
+        result = {'messages': [{'id': f"{index:08x}", 'threadId': f"{index // 3:08x}"} for index in indexes]}
+        if end < self.message_count:
+            result['nextPageToken'] = str(end)
+        return FakeRequest(lambda: result, self.latency)
+
+    def get(self, userId, id, format='full', metadataHeaders=None):
+        if format == 'metadata':
+            return FakeRequest(lambda: self.make_metadata(int(id, 16), metadataHeaders or []))
+        return FakeRequest(lambda: self.make_message(int(id, 16)))
+
+    def make_metadata(self, index, header_names):
+        message = self.make_message(index)
+        headers = [header for header in message['payload']['headers'] if header['name'] in header_names]
+        message['payload'] = {'mimeType': message['payload']['mimeType'], 'headers': headers}
+        return message
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback, self.latency)
+
+class FakeRequest:
+    def __init__(self, handler, latency=0.0):
+        self.handler = handler
+        self.latency = latency
+
+    def execute(self, http=None):
+        time.sleep(self.latency)
+        return self.handler()
+
+# A batch costs one round trip, like the real batch endpoint.
+class FakeBatch:
+    def __init__(self, callback, latency):
+        self.callback = callback
+        self.latency = latency
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id))
+
+    def execute(self, http=None):
+        time.sleep(self.latency)
+        for request, callback, request_id in self.requests:
+            callback(request_id, request.execute(), None)
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("Rate limit reached")
+        self.response = SimpleNamespace(headers={'retry-after': f"{retry_after:.2f}"})
+
+# Chat completions endpoint with a fixed latency and an optional requests per minute
+# limit, answering over the limit with 429 and retry-after like the real API.
+class FakeChatCompletions:
+    def __init__(self, latency=0.0, requests_per_minute=0):
+        self.latency = latency
+        self.requests_per_minute = requests_per_minute
+        self.lock = threading.Lock()
+        self.history = deque()
+
+    def create(self, model, messages, max_tokens, temperature, response_format=None):
+        if self.requests_per_minute:
+            with self.lock:
+                now = time.monotonic()
+                while self.history and now - self.history[0] >= 60:
+                    self.history.popleft()
+                if len(self.history) >= self.requests_per_minute:
+                    raise FakeRateLimitError(60 - (now - self.history[0]))
+                self.history.append(now)
+
+        time.sleep(self.latency)
+        prompt = "".join(message['content'] for message in messages)
+        rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).hexdigest())
+        content = " ".join(rng.choice(WORDS) for _ in range(min(max_tokens, 120))).capitalize() + "."
+        if response_format:
+            # Batch requests end with the JSON list of emails and expect a summary for each id
+            emails = json.loads(messages[-1]['content'].split('**Emails**:', 1)[1])
+            content = json.dumps({'summaries': [{'id': email['id'], 'summary': content} for email in emails]})
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4),
+        )
+
+# Text-to-Speech client returning silence about the size of real MP3 audio for the text.
+class FakeTextToSpeech:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def synthesize_speech(self, input, voice, audio_config):
+        time.sleep(self.latency)
+        return SimpleNamespace(audio_content=bytes(len(input.text.encode('utf-8')) * 270))
+
+# Replaces GmailSummarizer.services, which creates the real clients.
+class FakeServices:
+    def __init__(self, gmail, openai, tts):
+        self.gmail = gmail
+        self.openai = SimpleNamespace(chat=SimpleNamespace(completions=openai))
+        self.tts = tts
+
+    @contextmanager
+    def gmail_http(self):
+        yield None
+
+# Keeps every timing as well as the totals, for the percentiles.
+class SampledMetrics(GmailSummarizer.Metrics):
+    def reset(self):
+        super().reset()
+        self.samples = {}
+
+    def observe(self, stage, seconds):
+        super().observe(stage, seconds)
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(fraction * (len(values) - 1)))]
+
+# Reset the peak memory of this process, only possible on Linux.
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+# Peak memory of this process in MB, None when it cannot be read. Worker processes are not included.
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+# Point every file the pipeline writes at the given folder.
+def use_directory(directory):
+    for name, file_name in (
+        ('EMAILS_DB_PATH', 'emails.db'), ('OUTPUT_DIR', 'output'), ('SUMMARY_CACHE_DIR', 'summaries'),
+        ('DIGEST_CACHE_DIR', 'digests'), ('TTS_CACHE_DIR', 'audio'),
+    ):
+        setattr(GmailSummarizer, name, os.path.join(directory, file_name))
+    output_dir = GmailSummarizer.OUTPUT_DIR
+    GmailSummarizer.SUMMARY_FILE_PATH = os.path.join(output_dir, 'email_summary.txt')
+    GmailSummarizer.TTS_OUTPUT_FILE_PATH = os.path.join(output_dir, 'formatted_summary.txt')
+    GmailSummarizer.TTS_AUDIO_OUTPUT_FILE_PATH = os.path.join(output_dir, 'email_summary.mp3')
+    GmailSummarizer.METRICS_FILE_PATH = os.path.join(output_dir, 'run_metrics.json')
+    GmailSummarizer.ensure_directories()
+
+# Stages in pipeline order. Each one runs on the output of the one before.
+PIPELINE_STAGES = [
+    ('fetch', lambda gmail, args: len(GmailSummarizer.get_emails_within_timeframe(gmail, 24))),
+    ('sync', lambda gmail, args: GmailSummarizer.sync_emails(gmail, 24, full=True)['added']),
+    ('summarize', lambda gmail, args: GmailSummarizer.process_emails(args.concurrency)['summarized']),
+    ('digest', lambda gmail, args: GmailSummarizer.format_for_tts()),
+    ('speak', lambda gmail, args: GmailSummarizer.text_to_speech()),
+]
+
+def run_scenario(message_count, args, directory):
+    use_directory(directory)
+    gmail = FakeGmail(message_count, args.gmail_latency, args.seed)
+    GmailSummarizer.services = FakeServices(
+        gmail, FakeChatCompletions(args.llm_latency, args.llm_rpm), FakeTextToSpeech(args.tts_latency)
+    )
+    # The client budget matches the stand-in limit, so 429 responses only come from bursts
+    GmailSummarizer.rate_limiter = GmailSummarizer.RateLimiter(args.llm_rpm or 10 ** 9, 10 ** 12)
+
+    results = []
+    for stage, run_stage in PIPELINE_STAGES:
+        if stage not in args.stages:
+            continue
+        if stage == 'speak' and GmailSummarizer.import_optional('google.cloud.texttospeech') is None:
+            print("Skipping speak, google-cloud-texttospeech is not installed")
+            continue
+
+        GmailSummarizer.metrics.reset()
+        reset_peak_rss()
+        start = time.perf_counter()
+        output = run_stage(gmail, args)
+        elapsed = time.perf_counter() - start
+
+        results.append({
+            'messages': message_count,
+            'stage': stage,
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(message_count / elapsed, 1),
+            'peak_rss_mb': peak_rss_mb(),
+            'output': output,
+            'counters': dict(GmailSummarizer.metrics.counters),
+            'calls': {
+                name: {
+                    'count': len(samples),
+                    'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+                    'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+                }
+                for name, samples in sorted(GmailSummarizer.metrics.samples.items())
+            },
+        })
+    return results
+
+def print_scenario(results):
+    print(f"{'Stage':<12}{'Messages':>10}{'Seconds':>10}{'Msgs/sec':>12}{'Peak RSS MB':>13}")
+    for result in results:
+        rss = f"{result['peak_rss_mb']:.1f}" if result['peak_rss_mb'] is not None else "n/a"
+        print(
+            f"{result['stage']:<12}{result['messages']:>10}{result['seconds']:>10.2f}"
+            f"{result['messages_per_second']:>12.1f}{rss:>13}"
+        )
+        for name, calls in result['calls'].items():
+            print(f"  {name:<20}{calls['count']:>10} calls  p50 {calls['p50_ms']:>9.3f} ms  p99 {calls['p99_ms']:>9.3f} ms")
+    print()
+
+def benchmark_pipeline(args):
+    GmailSummarizer.metrics = SampledMetrics()
+    all_results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        GmailSummarizer.LOG_FILE_PATH = os.path.join(directory, 'app.log')
+        GmailSummarizer.configure_logging()
+
+        for message_count in args.messages:
+            print(f"Scenario: {message_count} messages")
+            # Every scenario starts with empty caches and an empty store
+            results = run_scenario(message_count, args, os.path.join(directory, str(message_count)))
+            print_scenario(results)
+            all_results += results
+
+        # Release the log file so the folder can be deleted on Windows
+        GmailSummarizer.logging.shutdown()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as results_file:
+            json.dump(all_results, results_file, indent=4)
+        print(f"Results saved to {args.json}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Gmail Summarizer benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    extract_parser = subparsers.add_parser('extract', help="Compare the HTML extractors on saved Gmail messages")
+    extract_parser.add_argument('corpus_dir', help="Folder of Gmail messages saved as JSON")
+    extract_parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs per extractor")
+
+    startup_parser = subparsers.add_parser('startup', help="Measure the import time of the menu actions and commands")
+    startup_parser.add_argument('--repeat', type=int, default=5, help="Number of cold starts per scenario")
+
+    pipeline_parser = subparsers.add_parser('pipeline', help="Measure each pipeline stage against local stand-ins for the APIs")
+    pipeline_parser.add_argument('--messages', type=int, nargs='+', default=[100, 1000], help="Message counts to run, 100 to 100000")
+    pipeline_parser.add_argument(
+        '--stages', nargs='+', choices=[stage for stage, _ in PIPELINE_STAGES],
+        default=[stage for stage, _ in PIPELINE_STAGES], help="Stages to run, later stages need the earlier ones"
+    )
+    pipeline_parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic messages")
+    pipeline_parser.add_argument('--concurrency', type=int, default=GmailSummarizer.SUMMARY_CONCURRENCY, help="Emails summarized at the same time")
+    pipeline_parser.add_argument('--gmail-latency', type=float, default=0.05, help="Seconds per Gmail list page and batch request")
+    pipeline_parser.add_argument('--llm-latency', type=float, default=0.02, help="Seconds per chat completion")
+    pipeline_parser.add_argument('--llm-rpm', type=int, default=0, help="Chat completion requests per minute, 0 for no limit")
+    pipeline_parser.add_argument('--tts-latency', type=float, default=0.2, help="Seconds per Text-to-Speech request")
+    pipeline_parser.add_argument('--json', help="Also save the results to this JSON file, to compare runs")
+
+    args = parser.parse_args()
+    if args.command == 'extract':
+        benchmark_extract(args.corpus_dir, args.repeat)
+    elif args.command == 'startup':
+        benchmark_startup(args.repeat)
+    elif args.command == 'pipeline':
+        benchmark_pipeline(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import pytest
+
+from GmailSummarizer import build_cli_parser
+
+
+@pytest.mark.parametrize("argv", [
+    ["--json", "summarize"],
+    ["summarize", "--json"],
+])
+def test_output_options_before_or_after_the_command(argv):
+    args = build_cli_parser().parse_args(argv)
+    assert args.command == "summarize"
+    assert args.json is True
+
+
+def test_option_before_the_command_is_kept():
+    args = build_cli_parser().parse_args(["--log-level", "DEBUG", "--stats-file", "stats.jsonl", "sync", "--full"])
+    assert args.log_level == "DEBUG"
+    assert args.stats_file == "stats.jsonl"
+    assert args.full is True
+
+
+def test_output_option_defaults():
+    args = build_cli_parser().parse_args(["digest"])
+    assert args.json is False
+    assert args.stats_file is None
+    assert args.metrics_file is None
+    assert args.prometheus_file is None
+    assert args.log_level is None
@@ -0,0 +1,35 @@
+from GmailSummarizer import merge_thread, summary_text
+
+EARLIER = "The plan for the launch covers design, budget and hiring for the next quarter. " * 12
+
+
+def make_row(message_id, sender, date, text):
+    return {'id': message_id, 'sender': sender, 'date': date, 'stripped_text': text}
+
+
+def test_merges_replies_oldest_first():
+    merged = merge_thread([
+        make_row('b', 'Bob <b@x.com>', 'Tue, 2 Jan 2024 10:00:00 +0000', 'Second.'),
+        make_row('a', 'Alice <a@x.com>', 'Mon, 1 Jan 2024 10:00:00 +0000', 'First.'),
+    ])
+    assert merged['id'] == 'b'
+    assert merged['members'] == ['a']
+    assert merged['stripped_text'].index('First.') < merged['stripped_text'].index('Second.')
+
+
+def test_later_reply_is_kept():
+    merged = merge_thread([
+        make_row('a', 'Alice <a@x.com>', 'Mon, 1 Jan 2024 10:00:00 +0000', 'Can you confirm the date?'),
+        make_row('b', 'Bob <b@x.com>', 'Tue, 2 Jan 2024 10:00:00 +0000', 'Sure, as I wrote: it will be ready Thursday.'),
+    ])
+    assert 'it will be ready Thursday.' in summary_text(merged)
+
+
+def test_merged_text_is_not_trimmed_again():
+    # The footer phrase is early in Bob's reply but near the end of the merged thread
+    reply = "You are receiving this email because you asked: the build is ready Thursday and the launch is on track."
+    merged = merge_thread([
+        make_row('a', 'Alice <a@x.com>', 'Mon, 1 Jan 2024 10:00:00 +0000', EARLIER),
+        make_row('b', 'Bob <b@x.com>', 'Tue, 2 Jan 2024 10:00:00 +0000', reply),
+    ])
+    assert reply in summary_text(merged)
@@ -0,0 +1,72 @@
+from GmailSummarizer import find_quoted_reply, prepare_email_text
+
+LONG_BODY = "The quarterly numbers are in and the team hit every target this time. " * 5
+
+
+def test_keeps_plain_text():
+    assert prepare_email_text("  Lunch at noon on Friday?  ") == "Lunch at noon on Friday?"
+
+
+def test_removes_gmail_attribution():
+    text = "Sounds good, see you then. On Mon, Jan 1, 2024 at 10:00 AM Bob <bob@example.com> wrote: > Are we still on?"
+    assert prepare_email_text(text) == "Sounds good, see you then."
+
+
+def test_removes_short_date_attribution():
+    text = "Agreed. On 1/2/2024 Bob wrote: earlier message"
+    assert prepare_email_text(text) == "Agreed."
+
+
+def test_keeps_wrote_in_prose():
+    text = "Thanks for the notes. Following up on the proposal you wrote: we need budget approval by Friday."
+    assert prepare_email_text(text) == text
+
+
+def test_keeps_capitalized_on_without_date():
+    text = "On the proposal you wrote: we need budget approval by Friday."
+    assert prepare_email_text(text) == text
+
+
+def test_attribution_after_an_earlier_on():
+    text = "Agreed. On the call I said the same. On 1/2/2024 Bob wrote: earlier message"
+    assert prepare_email_text(text) == "Agreed. On the call I said the same."
+
+
+def test_removes_outlook_header_block():
+    text = (
+        "Yes, go ahead. From: Bob Smith <bob@example.com> Sent: Monday, January 1, 2024 10:00 AM "
+        "To: Alice Subject: Re: Plan earlier message"
+    )
+    assert prepare_email_text(text) == "Yes, go ahead."
+
+
+def test_keeps_from_and_sent_in_prose():
+    text = "Hi all. From: the finance side we need numbers. Sent: the invoices last week, approve them by noon tomorrow."
+    assert prepare_email_text(text) == text
+
+
+def test_removes_original_message_separator():
+    assert prepare_email_text("Yes please. -----Original Message----- earlier message") == "Yes please."
+
+
+def test_find_quoted_reply_without_reply():
+    assert find_quoted_reply("Nothing quoted in here at all.") is None
+
+
+def test_removes_footer_near_the_end():
+    text = LONG_BODY + "You are receiving this email because you signed up for updates."
+    assert prepare_email_text(text) == LONG_BODY.strip()
+
+
+def test_removes_mobile_signature():
+    assert prepare_email_text(LONG_BODY + "Sent from my iPhone") == LONG_BODY.strip()
+
+
+def test_keeps_unsubscribe_question():
+    text = LONG_BODY + "How do I unsubscribe from the vendor list? Also the budget is due Monday."
+    assert prepare_email_text(text) == text.strip()
+
+
+def test_keeps_footer_phrase_early_in_the_email():
+    text = "You are receiving this email because you asked about the budget. " + LONG_BODY
+    assert prepare_email_text(text) == text.strip()
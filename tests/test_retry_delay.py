@@ -0,0 +1,23 @@
+import json
+from types import SimpleNamespace
+
+from GmailSummarizer import get_retry_delay
+
+
+class FakeHttpError(Exception):
+    def __init__(self, status, reason=None):
+        super().__init__(status)
+        self.resp = SimpleNamespace(status=status, get=lambda key, default=None: None)
+        self.content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}] if reason else []}}).encode()
+
+
+def test_gmail_rate_limit_403_is_retried():
+    assert get_retry_delay(FakeHttpError(403, 'userRateLimitExceeded'), 0) is not None
+    assert get_retry_delay(FakeHttpError(403, 'rateLimitExceeded'), 0) is not None
+    assert get_retry_delay(FakeHttpError(429), 0) is not None
+
+
+def test_other_client_errors_are_not_retried():
+    assert get_retry_delay(FakeHttpError(403, 'insufficientPermissions'), 0) is None
+    assert get_retry_delay(FakeHttpError(404), 0) is None
+    assert get_retry_delay(ValueError('bad'), 0) is None
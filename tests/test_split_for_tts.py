@@ -0,0 +1,50 @@
+from GmailSummarizer import TTS_MAX_CHUNK_BYTES, split_for_tts, split_utf8
+
+
+def chunk_sizes(chunks):
+    return [len(chunk.encode('utf-8')) for chunk in chunks]
+
+
+def test_short_text_is_one_chunk():
+    assert split_for_tts("Good morning. You have three new emails.") == ["Good morning. You have three new emails."]
+
+
+def test_breaks_between_sentences():
+    sentence = "This sentence is about forty bytes long."
+    chunks = split_for_tts(" ".join([sentence] * 300))
+    assert len(chunks) > 1
+    assert all(chunk.endswith(".") for chunk in chunks)
+    assert max(chunk_sizes(chunks)) <= TTS_MAX_CHUNK_BYTES
+
+
+def test_splits_long_sentence_between_words():
+    text = " ".join(["word"] * 3000)
+    chunks = split_for_tts(text)
+    assert max(chunk_sizes(chunks)) <= TTS_MAX_CHUNK_BYTES
+    assert " ".join(chunks) == text
+
+
+def test_splits_word_over_the_limit():
+    url = "https://example.com/" + "a" * 6000
+    chunks = split_for_tts(f"Read more at {url} today.")
+    assert max(chunk_sizes(chunks)) <= TTS_MAX_CHUNK_BYTES
+    assert "".join(chunks).replace(" ", "") == f"Readmoreat{url}today."
+
+
+def test_split_utf8_keeps_characters_whole():
+    pieces = split_utf8("é" * 10, 3)
+    assert pieces == ["é"] * 10
+    assert "".join(split_utf8("a€b€c", 4)) == "a€b€c"
+
+
+def test_edit_only_changes_the_chunks_around_it():
+    sentences = [f"Email number {index} from the team says the report is ready for review." for index in range(200)]
+    chunks = split_for_tts(" ".join(sentences))
+    sentences[100] = sentences[100][:-1] + ", and the client has already signed off on it."
+    edited = split_for_tts(" ".join(sentences))
+    assert len(set(edited) - set(chunks)) <= 2
+    assert len(chunks) > 2
+
+
+def test_line_breaks_end_chunks():
+    assert split_for_tts("Good morning.\n\nYou have three new emails.") == ["Good morning.", "You have three new emails."]
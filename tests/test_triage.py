@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import GmailSummarizer
+from GmailSummarizer import list_history_changes, triage_enabled, triage_query
+
+
+def set_rules(monkeypatch, labels=(), allow=(), deny=(), bulk=False, max_size=0):
+    monkeypatch.setattr(GmailSummarizer, 'TRIAGE_SKIP_LABELS', list(labels))
+    monkeypatch.setattr(GmailSummarizer, 'TRIAGE_SENDER_ALLOWLIST', list(allow))
+    monkeypatch.setattr(GmailSummarizer, 'TRIAGE_SENDER_DENYLIST', list(deny))
+    monkeypatch.setattr(GmailSummarizer, 'TRIAGE_SKIP_BULK_MAIL', bulk)
+    monkeypatch.setattr(GmailSummarizer, 'TRIAGE_MAX_SIZE_BYTES', max_size)
+
+
+def test_default_rule_needs_no_metadata(monkeypatch):
+    set_rules(monkeypatch, labels=['CATEGORY_PROMOTIONS'])
+    assert triage_query() == '(-category:promotions)'
+    assert not triage_enabled(listed=True)
+    assert triage_enabled()
+
+
+def test_sender_and_size_rules_with_allowlist(monkeypatch):
+    set_rules(monkeypatch, labels=['CATEGORY_PROMOTIONS'], allow=['boss@example.com'], deny=['@ads.example'], max_size=1000)
+    assert triage_query() == '((-category:promotions -from:ads.example smaller:1001) OR from:boss@example.com)'
+
+
+def test_no_rules(monkeypatch):
+    set_rules(monkeypatch, allow=['boss@example.com'])
+    assert triage_query() == ''
+    assert not triage_enabled()
+
+
+def test_header_and_unknown_label_rules_need_metadata(monkeypatch):
+    set_rules(monkeypatch, bulk=True)
+    assert triage_enabled(listed=True)
+    set_rules(monkeypatch, labels=['Label_12'])
+    assert triage_query() == ''
+    assert triage_enabled(listed=True)
+
+
+def test_history_labels_replace_the_metadata_pass(monkeypatch):
+    set_rules(monkeypatch, labels=['CATEGORY_PROMOTIONS'])
+    assert not triage_enabled(labelled=True)
+    set_rules(monkeypatch, labels=['CATEGORY_PROMOTIONS'], allow=['boss@example.com'])
+    assert triage_enabled(labelled=True)
+
+
+def history_service(records):
+    response = {'history': records, 'historyId': '200'}
+    request = SimpleNamespace(execute=lambda http=None: response)
+    history = SimpleNamespace(list=lambda **kwargs: request)
+    return SimpleNamespace(users=lambda: SimpleNamespace(history=lambda: history))
+
+
+def message(message_id, *labels):
+    return {'message': {'id': message_id, 'threadId': 't1', 'labelIds': list(labels)}}
+
+
+def test_history_skips_labels_spam_and_trash(monkeypatch):
+    set_rules(monkeypatch, labels=['CATEGORY_PROMOTIONS'])
+    service = history_service([
+        {'messagesAdded': [message('kept', 'INBOX'), message('promo', 'CATEGORY_PROMOTIONS'), message('spam', 'SPAM')]},
+        {'labelsAdded': [dict(message('trashed', 'TRASH'), labelIds=['TRASH'])]},
+        {'labelsRemoved': [dict(message('restored', 'INBOX'), labelIds=['TRASH'])]},
+    ])
+    added, deleted, history_id = list_history_changes(service, '100')
+    assert added == {'kept': 't1', 'restored': 't1'}
+    assert deleted == {'spam', 'trashed'}
+    assert history_id == '200'